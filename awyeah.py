@@ -4,8 +4,12 @@ import argparse
 import math
 import sys
 from translator import translator
+from translator.cache import CachedTranslation
+from translator.cache import TranslationCache
+from translator.cache import DEFAULT_CACHE_SIZE
 from midi import midi
 from pico8.game import game
+from pico8 import util
 
 # Constants
 PICO8_NUM_CHANNELS = 4
@@ -17,309 +21,502 @@ PICO8_MAX_VOLUME = 7
 MIDI_MAX_TRACKS = 128
 
 # Defaults for Song-Specific Config
-songConfig = {
-    'mute': MIDI_MAX_TRACKS * [0],
-    'octaveShift': MIDI_MAX_TRACKS * [0],
-    'volumeShift': MIDI_MAX_TRACKS * [0],
-    'waveform': MIDI_MAX_TRACKS * [0]
-}
-
-# Assign default waveforms to the first 128 MIDI tracks
-w = 0
-for track in range(MIDI_MAX_TRACKS):
-    songConfig['waveform'][track] = w
-    w += 1
-    if w == 6:
-        w = 0
-
-# Parse command-line arguments
-argParser = argparse.ArgumentParser()
-argParser.add_argument(
-        'midiPath',
-        help="The path to the MIDI file to be translated")
-argParser.add_argument(
-        'cartPath',
-        help="The path to PICO-8 cartridge file to be generated",
-        nargs='?',
-        default='midi_out.p8')
-argParser.add_argument(
-        '--legato',
-        help="Disable fadeout effect at the end of any notes (even repeated " +
-             "notes)",
-        action="store_true")
-argParser.add_argument(
-        '--staccato',
-        help="Add a fadeout effect at the end of every note",
-        action='store_true')
-argParser.add_argument(
-        '--no-fix-octaves',
-        help="Do not change octaves of tracks to keep them in PICO-8 range",
-        action='store_true')
-argParser.add_argument(
-        '--no-quantize',
-        help="Do not perform any quantization of note lengths",
-        action='store_true')
-argParser.add_argument(
-        '-t',
-        '--midi-base-ticks',
-        help="Override MIDI ticks per PICO-8 note setting (normally " +
-             "auto-detected)",
-        type=int)
-argParser.add_argument(
-        '-d',
-        '--note-duration',
-        help="Override PICO-8 note duration setting (normally auto-detected " +
-             "from MIDI tempo)",
-        type=int)
-argParser.add_argument(
-        '--midi-offset',
-        help="Change the start point in the MIDI file (in # of PICO-8 SFX)",
-        type=int,
-        default=0)
-argParser.add_argument(
-        '--sfx-offset',
-        help="Change the starting SFX slot in PICO-8",
-        type=int,
-        default=0)
-argParser.add_argument(
-        '--pattern-offset',
-        help="Change the starting music pattern slot in PICO-8",
-        type=int,
-        default=0)
-argParser.add_argument(
-        '--no-compact',
-        help="Don't try to compact groups of repeated notes into fewer " +
-             "notes played for longer (this compacting is sometimes slow, " +
-             "so using this flag will speed up processing time at the cost " +
-             "of possibly occupying more SFXes in the PICO-8 cart)",
-         action='store_true')
-argParser.add_argument(
-        '--no-trim-silence',
-        help="Don't trim silence off the beginning",
-        action='store_true')
-argParser.add_argument(
-        '--waveform',
-        help="Specify which PICO-8 waveform (instrument) number to use for " +
-             "each MIDI track",
-        nargs='*',
-        type=int,
-        default=songConfig['waveform'])
-argParser.add_argument(
-        '--octave-shift',
-        help="Specify the number of octaves to shift each MIDI track",
-        nargs='*',
-        type=int,
-        default=songConfig['octaveShift'])
-argParser.add_argument(
-        '--volume-shift',
-        help='Specify a number to add to the volume of all notes in each ' +
-              'MIDI track (volume for each note will be limited to the ' +
-              'range 1-7',
-        nargs='*',
-        type=int,
-        default=songConfig['volumeShift'])
-argParser.add_argument(
-        '--mute',
-        help='Specify whether to "mute" each MIDI track ' +
-             '(1 = mute, 0 = do not mute). Notes for a muted track will be ' +
-             'excluded from the PICO-8 cartridge entirely',
-        nargs='*',
-        type=int,
-        default=songConfig['mute'])
-
-args = argParser.parse_args()
-
-# Set translator settings according to command-line arugments
-translatorSettings = translator.TranslatorSettings()
-translatorSettings.quantization = not args.no_quantize
-translatorSettings.ticksPerNoteOverride = args.midi_base_ticks
-translatorSettings.staccato = args.staccato
-translatorSettings.legato = args.legato
-translatorSettings.fixOctaves = not args.no_fix_octaves
-translatorSettings.noteDurationOverride = args.note_duration
-translatorSettings.sfxCompactor = not args.no_compact
-translatorSettings.trimSilence = not args.no_trim_silence
-
-# Set song-specific tracker-related settings from command-line arguments
-for i, value in enumerate(args.waveform):
-    songConfig['waveform'][i] = value
-for i, value in enumerate(args.octave_shift):
-    songConfig['octaveShift'][i] = value
-for i, value in enumerate(args.volume_shift):
-    songConfig['volumeShift'][i] = value
-for i, value in enumerate(args.mute):
-    songConfig['mute'][i] = value
-
-# Open the MIDI file
-midiFile = midi.MidiFile()
-midiFile.open(args.midiPath)
-midiFile.read()
-
-translator = translator.Translator(midiFile, translatorSettings)
-
-translator.analyze()
-
-# Get all the notes converted to "tracks" where a "track" is a list of
-# translator.Sfx objects
-tracks = translator.get_sfx_lists()
-
-# Make an empty PICO-8 catridge
-cart = game.Game.make_empty_game()
-lines = [
-    'music(' + str(args.pattern_offset) + ')\n',
-    'function _update()\n',
-    'end']
-cart.lua.update_from_lines(lines)
-
-if args.midi_offset > 0:
-    # Remove SFXes from the beginning of each track, based on the "start
-    # offset" parameter
-    for t, track in enumerate(tracks):
-        tracks[t] = track[args.midi_offset:]
+def make_song_config():
+    songConfig = {
+        'mute': MIDI_MAX_TRACKS * [0],
+        'octaveShift': MIDI_MAX_TRACKS * [0],
+        'volumeShift': MIDI_MAX_TRACKS * [0],
+        'waveform': MIDI_MAX_TRACKS * [0]
+    }
+
+    # Assign default waveforms to the first 128 MIDI tracks
+    w = 0
+    for track in range(MIDI_MAX_TRACKS):
+        songConfig['waveform'][track] = w
+        w += 1
+        if w == 6:
+            w = 0
+
+    return songConfig
+
+def make_arg_parser(songConfig):
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument(
+            'midiPath',
+            help="The path to the MIDI file to be translated")
+    argParser.add_argument(
+            'cartPath',
+            help="The path to PICO-8 cartridge file to be generated",
+            nargs='?',
+            default='midi_out.p8')
+    argParser.add_argument(
+            '--legato',
+            help="Disable fadeout effect at the end of any notes (even repeated " +
+                 "notes)",
+            action="store_true")
+    argParser.add_argument(
+            '--staccato',
+            help="Add a fadeout effect at the end of every note",
+            action='store_true')
+    argParser.add_argument(
+            '--polyphony',
+            help="Split chords (or any notes that overlap on the same MIDI " +
+                 "channel) into as few separate tracks as possible, instead " +
+                 "of cutting each note off when the next one starts",
+            action='store_true')
+    argParser.add_argument(
+            '--merge-tracks',
+            help="Combine tracks that never play notes at the same time into " +
+                 "one track, to use fewer PICO-8 channels and SFXes (per-" +
+                 "track settings such as --waveform then apply to the " +
+                 "combined tracks, in order)",
+            action='store_true')
+    argParser.add_argument(
+            '--no-fix-octaves',
+            help="Do not change octaves of tracks to keep them in PICO-8 range",
+            action='store_true')
+    argParser.add_argument(
+            '--best-fit-octaves',
+            help="When a track is too wide for the PICO-8 pitch range, shift " +
+                 "it by the number of octaves that leaves the fewest notes " +
+                 "out of range (normally such tracks are not shifted)",
+            action='store_true')
+    argParser.add_argument(
+            '--no-quantize',
+            help="Do not perform any quantization of note lengths",
+            action='store_true')
+    argParser.add_argument(
+            '-t',
+            '--midi-base-ticks',
+            help="Override MIDI ticks per PICO-8 note setting (normally " +
+                 "auto-detected)",
+            type=int)
+    argParser.add_argument(
+            '-d',
+            '--note-duration',
+            help="Override PICO-8 note duration setting (normally auto-detected " +
+                 "from MIDI tempo)",
+            type=int)
+    argParser.add_argument(
+            '--midi-offset',
+            help="Change the start point in the MIDI file (in # of PICO-8 SFX)",
+            type=int,
+            default=0)
+    argParser.add_argument(
+            '--sfx-offset',
+            help="Change the starting SFX slot in PICO-8",
+            type=int,
+            default=0)
+    argParser.add_argument(
+            '--pattern-offset',
+            help="Change the starting music pattern slot in PICO-8",
+            type=int,
+            default=0)
+    argParser.add_argument(
+            '--no-compact',
+            help="Don't try to compact groups of repeated notes into fewer " +
+                 "notes played for longer (this compacting is sometimes slow, " +
+                 "so using this flag will speed up processing time at the cost " +
+                 "of possibly occupying more SFXes in the PICO-8 cart)",
+             action='store_true')
+    argParser.add_argument(
+            '--greedy-compact',
+            help="Only compact repeated notes greedily from the start of the " +
+                 "song (by default, a planned compaction is tried as well, " +
+                 "and whichever uses fewer SFXes is kept)",
+            action='store_true')
+    argParser.add_argument(
+            '--per-channel-compact',
+            help="Let each track's repeated notes be compacted by a " +
+                 "different amount (e.g. a sparse bass line more than a busy " +
+                 "melody), ending the shorter SFXes early to keep the " +
+                 "channels in time (the cart needs PICO-8 0.2.0 or later)",
+            action='store_true')
+    argParser.add_argument(
+            '--no-trim-silence',
+            help="Don't trim silence off the beginning",
+            action='store_true')
+    argParser.add_argument(
+            '--waveform',
+            help="Specify which PICO-8 waveform (instrument) number to use for " +
+                 "each MIDI track",
+            nargs='*',
+            type=int,
+            default=songConfig['waveform'])
+    argParser.add_argument(
+            '--octave-shift',
+            help="Specify the number of octaves to shift each MIDI track",
+            nargs='*',
+            type=int,
+            default=songConfig['octaveShift'])
+    argParser.add_argument(
+            '--volume-shift',
+            help='Specify a number to add to the volume of all notes in each ' +
+                  'MIDI track (volume for each note will be limited to the ' +
+                  'range 1-7',
+            nargs='*',
+            type=int,
+            default=songConfig['volumeShift'])
+    argParser.add_argument(
+            '--mute',
+            help='Specify whether to "mute" each MIDI track ' +
+                 '(1 = mute, 0 = do not mute). Notes for a muted track will be ' +
+                 'excluded from the PICO-8 cartridge entirely',
+            nargs='*',
+            type=int,
+            default=songConfig['mute'])
+    argParser.add_argument(
+            '--midi-tracks',
+            help="Only translate these MIDI tracks (numbered from 0, as they " +
+                 "are stored in the MIDI file); the other tracks are never " +
+                 "decoded, which saves time on big files. Unlike --mute, " +
+                 "this leaves the other tracks out of the analysis too (e.g. " +
+                 "of the base note length)",
+            nargs='+',
+            type=int)
+    argParser.add_argument(
+            '--no-cache',
+            help="Don't use the translation cache (by default, translations " +
+                 "are cached on disk, so changing only --waveform, " +
+                 "--octave-shift, --volume-shift, --mute or the offsets " +
+                 "doesn't need the MIDI file to be translated again)",
+            action='store_true')
+    argParser.add_argument(
+            '--cache-dir',
+            help="The directory for the translation cache (default: " +
+                 "$XDG_CACHE_HOME/awyeah or ~/.cache/awyeah)")
+    argParser.add_argument(
+            '--cache-size',
+            help="The maximum size of the translation cache in MiB; the " +
+                 "least recently used translations are removed to stay " +
+                 "under it",
+            type=int,
+            default=DEFAULT_CACHE_SIZE // (1024 * 1024))
+    argParser.add_argument(
+            '-q',
+            '--quiet',
+            help="Only print warnings and errors",
+            action='store_true')
+    argParser.add_argument(
+            '--debug',
+            help="Print extra messages for debugging the translation",
+            action='store_true')
+
+    return argParser
+
+def make_translator_settings(args):
+    # Set translator settings according to command-line arugments
+    translatorSettings = translator.TranslatorSettings()
+    translatorSettings.quantization = not args.no_quantize
+    translatorSettings.ticksPerNoteOverride = args.midi_base_ticks
+    translatorSettings.staccato = args.staccato
+    translatorSettings.legato = args.legato
+    translatorSettings.polyphony = args.polyphony
+    translatorSettings.mergeTracks = args.merge_tracks
+    translatorSettings.fixOctaves = not args.no_fix_octaves
+    translatorSettings.bestFitOctaves = args.best_fit_octaves
+    translatorSettings.noteDurationOverride = args.note_duration
+    translatorSettings.sfxCompactor = not args.no_compact
+    translatorSettings.greedyCompaction = args.greedy_compact
+    translatorSettings.independentCompaction = args.per_channel_compact
+    translatorSettings.trimSilence = not args.no_trim_silence
+    translatorSettings.midiTracks = args.midi_tracks
+    return translatorSettings
 
 def clamp(n, minn, maxn):
     return max(min(maxn, n), minn)
 
-# SfxDuplicateDetector creates a map of each trackSfx (which is a group of 32
-# notes in a track) and the PICO-8 SFX index to which it was written, so that
-# it can check if a given trackSfx was already written to the PICO-8 catridge
-# and instead return the existing SFX index so the music pattern can use that.
+# Encode a trackSfx (which is a group of 32 notes in a track) the way it will
+# be written to the PICO-8 cartridge for track number t, with the song config's
+# shifts and waveform applied. Return its SFX properties, a list of
+# (noteIndex, pitch, volume, effect, waveform) for the notes to write, and
+# whether it has any audible notes (even ones out of PICO-8's pitch range).
+def encode_track_sfx(trackSfx, t, songConfig):
+    # An SFX with a playLength is given a loop start with no loop end, which
+    # PICO-8 (since 0.2.0) treats as the SFX's length
+    loopStart = 0
+    if trackSfx.playLength != None:
+        loopStart = trackSfx.playLength
+    properties = (1, trackSfx.noteDuration, loopStart, 0)
+
+    encodedNotes = []
+    isAudible = False
+    notes = trackSfx.notes
+    for n in range(len(notes)):
+        volume = notes.volume(n)
+        if volume > 0:
+            pitch = notes.pitch(n)
+
+            # If there is a manual octave shift specified for this track
+            octaveShift = songConfig['octaveShift'][t]
+            if octaveShift != 0:
+                pitch += 12 * octaveShift
+
+            # Shift the volume as specified for this track
+            volume += songConfig['volumeShift'][t]
+            volume = clamp(volume, PICO8_MIN_VOLUME, PICO8_MAX_VOLUME)
+
+            isAudible = True
+            noteIsInRange = (pitch >= 0 and pitch <= PICO8_MAX_PITCH)
+            if noteIsInRange:
+                encodedNotes.append((n, pitch, volume, notes.effect(n),
+                                     songConfig['waveform'][t]))
+
+    return properties, encodedNotes, isAudible
+
+# SfxDuplicateDetector maps the content of each SFX written to the PICO-8
+# cartridge to the SFX index it was written to, so that it can check if an
+# identical SFX was already written and instead return the existing SFX index
+# so the music pattern can use that. It counts its hits (SFXes that were
+# reused) and misses (SFXes that had to be written).
 class SfxDuplicateDetector:
     def __init__(self):
         self.map = {}
-        map = {}
-
-    def record_tracksfx_index(self, sfxIndex, trackSfx):
-        self.map[sfxIndex] = trackSfx
-
+        self.hitCount = 0
+        self.missCount = 0
+
+    # Make the key for an encoded SFX: a tuple of its properties and of the
+    # notes that are written to it. This is canonical (notes that encode the
+    # same way in the cart give the same key), and since the map is a dict,
+    # keys with the same hash are still compared for equality, so a hash
+    # collision can't give a false match. Out-of-range values are left for
+    # the cart to reject when the SFX is written.
     @staticmethod
-    def sfx_match(sfx1, sfx2):
-        if len(sfx1.notes) != len(sfx2.notes) or sfx1.noteDuration != sfx2.noteDuration:
-            return False
-
-        for i in range(len(sfx1.notes)):
-            note1 = sfx1.notes[i]
-            note2 = sfx2.notes[i]
-
-            if (note1.pitch != note2.pitch or
-                note1.volume != note2.volume or
-                note1.waveform != note2.waveform or
-                note1.effect != note2.effect or
-                note1.length != note2.length):
-                return False
-
-        return True
-
-    def find_duplicate_sfx_index(self, sfx):
-        for sfxIndex, existingSfx in self.map.items():
-            if SfxDuplicateDetector.sfx_match(existingSfx, sfx):
-                return sfxIndex
-
-sfxDuplicateDetector = SfxDuplicateDetector()
-duplicateSfxSavingsCount = 0
-
-trackSfxIndex = 0
-musicIndex = args.pattern_offset
-sfxIndex = args.sfx_offset
-while sfxIndex < PICO8_NUM_SFX:
-    wroteAnythingToMusic = False
-    channelIndex = 0
-    for t, track in enumerate(tracks):
-        wroteAnyNotesToSfx = False
-        wroteAnythingToChannel = False
-
-        # Get the trackSfx, which is the next group of 32 notes in this track
-        if len(track) - 1 < trackSfxIndex:
-            continue
-        trackSfx = track[trackSfxIndex]
-
-        # If there is a "mute" specified for this track
-        if songConfig['mute'][t] == 1:
-            continue
-
-        # Check if this SFX is a duplicate of any that have already been
-        # written
-        duplicateSfxIndex = sfxDuplicateDetector.find_duplicate_sfx_index(
-                trackSfx)
-        if duplicateSfxIndex != None:
-            # Add the SFX to a music pattern
-            cart.music.set_channel(musicIndex, channelIndex, duplicateSfxIndex)
-            wroteAnythingToMusic = True
-            wroteAnythingToChannel = True
-            duplicateSfxSavingsCount += 1
-        elif sfxIndex < PICO8_NUM_SFX:
-            # Set the properites for this SFX
-            cart.sfx.set_properties(
-                    sfxIndex,
-                    editor_mode=1,
-                    loop_start=0,
-                    loop_end=0,
-                    note_duration=trackSfx.noteDuration)
-
-            # Add the 32 notes in this trackSfx
-            for n, note in enumerate(trackSfx.notes):
-                if note.volume > 0:
-                    pitch = note.pitch
-                    volume = note.volume
-
-                    # If there is a manual octave shift specified for this track
-                    octaveShift = songConfig['octaveShift'][t]
-                    if octaveShift != 0:
-                        pitch = note.pitch + (12 * octaveShift)
-
-                    # Shift the volume as specified for this track
-                    volume += songConfig['volumeShift'][t]
-                    volume = clamp(volume, PICO8_MIN_VOLUME, PICO8_MAX_VOLUME)
-
-                    wroteAnyNotesToSfx = True
-                    noteIsInRange = (pitch >= 0 and pitch <= PICO8_MAX_PITCH)
-                    if noteIsInRange:
-                        # Add this note to the current PICO-8 SFX
-                        cart.sfx.set_note(
-                                sfxIndex,
-                                n,
-                                pitch = pitch,
-                                volume = volume,
-                                effect = note.effect,
-                                waveform = songConfig['waveform'][t])
-
-        if wroteAnyNotesToSfx:
-            # Store the PICO-8 track number that this section of the track went in
-            sfxDuplicateDetector.record_tracksfx_index(sfxIndex, trackSfx)
-
-            # Add the SFX to a music pattern
-            cart.music.set_channel(musicIndex, channelIndex, sfxIndex)
-            wroteAnythingToMusic = True
-            wroteAnythingToChannel = True
-
-            # Move to the next SFX
-            sfxIndex += 1
-
-        if wroteAnythingToChannel:
-            # Move to the next PICO-8 music channel
-            channelIndex += 1
-            if channelIndex > PICO8_NUM_CHANNELS - 1:
-                break
-
-    trackSfxIndex += 1
-    if wroteAnythingToMusic:
-        musicIndex += 1
-    if musicIndex > PICO8_NUM_MUSIC - 1:
-        print('reached max music patterns')
-        break
-
-    # Check if the trackSfxIndex is past the end of all tracks
-    allTracksAreEnded = True
-    for track in tracks:
-        if trackSfxIndex < len(track):
-            allTracksAreEnded = False
+    def make_key(properties, encodedNotes):
+        key = [properties]
+        for n, pitch, volume, effect, waveform in encodedNotes:
+            if effect == None:
+                effect = 0
+            key.append((n, pitch, volume, effect, waveform))
+        return tuple(key)
+
+    def record_sfx_index(self, sfxIndex, key):
+        self.map.setdefault(key, sfxIndex)
+
+    def find_duplicate_sfx_index(self, key):
+        sfxIndex = self.map.get(key)
+        if sfxIndex == None:
+            self.missCount += 1
+        else:
+            self.hitCount += 1
+        return sfxIndex
+
+# Build a PICO-8 cartridge from the translated tracks (lists of translator.Sfx
+# objects)
+def make_cart(tracks, songConfig, patternOffset=0, sfxOffset=0, midiOffset=0):
+    # Make an empty PICO-8 catridge
+    cart = game.Game.make_empty_game()
+    lines = [
+        'music(' + str(patternOffset) + ')\n',
+        'function _update()\n',
+        'end']
+    cart.lua.update_from_lines(lines)
+
+    if midiOffset > 0:
+        # Remove SFXes from the beginning of each track, based on the "start
+        # offset" parameter
+        tracks = list(tracks)
+        for t, track in enumerate(tracks):
+            tracks[t] = track[midiOffset:]
+
+    sfxDuplicateDetector = SfxDuplicateDetector()
+
+    trackSfxIndex = 0
+    musicIndex = patternOffset
+    sfxIndex = sfxOffset
+    while sfxIndex < PICO8_NUM_SFX:
+        wroteAnythingToMusic = False
+        channelIndex = 0
+        for t, track in enumerate(tracks):
+            wroteAnyNotesToSfx = False
+            wroteAnythingToChannel = False
+
+            # Get the trackSfx, which is the next group of 32 notes in this track
+            if len(track) - 1 < trackSfxIndex:
+                continue
+            trackSfx = track[trackSfxIndex]
+
+            # If there is a "mute" specified for this track
+            if songConfig['mute'][t] == 1:
+                continue
+
+            properties, encodedNotes, isAudible = encode_track_sfx(
+                    trackSfx, t, songConfig)
+
+            # Check if this SFX is a duplicate of any that have already been
+            # written
+            duplicateSfxIndex = None
+            if isAudible:
+                key = SfxDuplicateDetector.make_key(properties, encodedNotes)
+                duplicateSfxIndex = sfxDuplicateDetector.find_duplicate_sfx_index(
+                        key)
+            if duplicateSfxIndex != None:
+                # Add the SFX to a music pattern
+                cart.music.set_channel(musicIndex, channelIndex, duplicateSfxIndex)
+                wroteAnythingToMusic = True
+                wroteAnythingToChannel = True
+            elif sfxIndex < PICO8_NUM_SFX:
+                # Set the properites for this SFX
+                editorMode, noteDuration, loopStart, loopEnd = properties
+                cart.sfx.set_properties(
+                        sfxIndex,
+                        editor_mode=editorMode,
+                        loop_start=loopStart,
+                        loop_end=loopEnd,
+                        note_duration=noteDuration)
+
+                # Add the notes in this trackSfx
+                for n, pitch, volume, effect, waveform in encodedNotes:
+                    cart.sfx.set_note(
+                            sfxIndex,
+                            n,
+                            pitch = pitch,
+                            volume = volume,
+                            effect = effect,
+                            waveform = waveform)
+                wroteAnyNotesToSfx = isAudible
+
+            if wroteAnyNotesToSfx:
+                # Store the PICO-8 SFX number that this section of the track went in
+                sfxDuplicateDetector.record_sfx_index(sfxIndex, key)
+
+                # Add the SFX to a music pattern
+                cart.music.set_channel(musicIndex, channelIndex, sfxIndex)
+                wroteAnythingToMusic = True
+                wroteAnythingToChannel = True
+
+                # Move to the next SFX
+                sfxIndex += 1
+
+            if wroteAnythingToChannel:
+                # Move to the next PICO-8 music channel
+                channelIndex += 1
+                if channelIndex > PICO8_NUM_CHANNELS - 1:
+                    break
+
+        trackSfxIndex += 1
+        if wroteAnythingToMusic:
+            musicIndex += 1
+        if musicIndex > PICO8_NUM_MUSIC - 1:
+            util.write('reached max music patterns\n')
             break
-    if allTracksAreEnded:
-        break
 
-if (duplicateSfxSavingsCount > 0):
-    print('optimized {0} occurences of duplicate SFX'.format(duplicateSfxSavingsCount))
+        # Check if the trackSfxIndex is past the end of all tracks
+        allTracksAreEnded = True
+        for track in tracks:
+            if trackSfxIndex < len(track):
+                allTracksAreEnded = False
+                break
+        if allTracksAreEnded:
+            break
 
-# Write the cart
-with open(args.cartPath, 'w', encoding='utf-8') as fh:
-    cart.to_p8_file(fh)
+    if (sfxDuplicateDetector.hitCount > 0):
+        util.write('optimized {0} occurences of duplicate SFX\n'.format(
+            sfxDuplicateDetector.hitCount))
+    util.debug('SFX deduplication: {0} hits, {1} misses\n'.format(
+        sfxDuplicateDetector.hitCount, sfxDuplicateDetector.missCount))
+
+    return cart
+
+# Translate a MIDI file (given as bytes) into a list of "tracks", or get the
+# translation from the cache if this file was already translated with the same
+# translator settings. A new translation is stored in the cache straight away.
+def translate(midiData, translatorSettings, cache=None):
+    if cache != None:
+        cachedTranslation = load_translation(cache, midiData,
+                                             translatorSettings)
+        if cachedTranslation != None:
+            util.write(('using cached translation (base ticks {0}, note ' +
+                        'duration {1})\n').format(
+                            cachedTranslation.baseTicks,
+                            cachedTranslation.noteDuration))
+            return cachedTranslation.sfxLists
+
+    midiFile = midi.MidiFile()
+    midiFile.readstr(midiData, columnar=True, lazy=True,
+                     keep=translator.Translator.MIDI_EVENT_TYPES)
+
+    songTranslator = translator.Translator(midiFile, translatorSettings)
+    songTranslator.analyze()
+    tracks = songTranslator.get_sfx_lists()
+
+    if cache != None:
+        store_translation(cache, midiData, translatorSettings,
+                          CachedTranslation(songTranslator, tracks))
+
+    return tracks
+
+def load_translation(cache, midiData, translatorSettings):
+    key = TranslationCache.make_key(midiData, translatorSettings)
+    try:
+        return cache.get(key)
+    except OSError as e:
+        util.error('could not read from the translation cache: {0}\n'.
+                   format(e))
+
+def store_translation(cache, midiData, translatorSettings, translation):
+    key = TranslationCache.make_key(midiData, translatorSettings)
+    try:
+        cache.put(key, translation)
+    except OSError as e:
+        util.error('could not write to the translation cache: {0}\n'.
+                   format(e))
+
+def main(argv=None):
+    songConfig = make_song_config()
+    argParser = make_arg_parser(songConfig)
+    args = argParser.parse_args(argv)
+    translatorSettings = make_translator_settings(args)
+
+    if args.debug:
+        util.set_verbosity(util.VERBOSITY_DEBUG)
+    elif args.quiet:
+        util.set_verbosity(util.VERBOSITY_QUIET)
+
+    # Set song-specific tracker-related settings from command-line arguments
+    for i, value in enumerate(args.waveform):
+        songConfig['waveform'][i] = value
+    for i, value in enumerate(args.octave_shift):
+        songConfig['octaveShift'][i] = value
+    for i, value in enumerate(args.volume_shift):
+        songConfig['volumeShift'][i] = value
+    for i, value in enumerate(args.mute):
+        songConfig['mute'][i] = value
+
+    if args.no_cache:
+        cache = None
+    else:
+        cache = TranslationCache(args.cache_dir,
+                                 args.cache_size * 1024 * 1024)
+
+    with open(args.midiPath, 'rb') as fh:
+        midiData = fh.read()
+
+    if args.midi_tracks != None:
+        # Only the MIDI file's chunks are indexed here, which is cheap
+        midiFile = midi.MidiFile()
+        midiFile.readstr(midiData, lazy=True)
+        for index in args.midi_tracks:
+            if not 0 <= index < len(midiFile.tracks):
+                argParser.error(
+                        ('argument --midi-tracks: MIDI track {0} does not ' +
+                         'exist (the file has tracks 0 to {1})').format(
+                             index, len(midiFile.tracks) - 1))
+
+    # Get all the notes converted to "tracks" where a "track" is a list of
+    # translator.Sfx objects
+    tracks = translate(midiData, translatorSettings, cache)
+
+    cart = make_cart(
+            tracks,
+            songConfig,
+            patternOffset=args.pattern_offset,
+            sfxOffset=args.sfx_offset,
+            midiOffset=args.midi_offset)
+
+    # Write the cart
+    with open(args.cartPath, 'w', encoding='utf-8') as fh:
+        cart.to_p8_file(fh)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import os
+import random
+
+from midi import midi
+
+# Deterministic generators for synthetic "stress" MIDI files. Each generator
+# takes a random.Random and a scale factor (1 = a few seconds of benchmark
+# time) and returns a midi.MidiFile; write_corpus() writes them all to disk.
+
+TICKS_PER_QUARTER_NOTE = 480
+THIRTY_SECOND_NOTE = TICKS_PER_QUARTER_NOTE // 8
+
+# Keep generated pitches inside what PICO-8 can play without octave fixing
+LOWEST_PITCH = 36
+HIGHEST_PITCH = 99
+
+class TrackBuilder:
+    def __init__(self, index):
+        self.track = midi.MidiTrack(index)
+        self.timedEvents = []
+
+    def add(self, time, type, channel=None, pitch=None, velocity=None,
+            data=None):
+        event = midi.MidiEvent(self.track)
+        event.time = time
+        event.type = type
+        event.channel = channel
+        event.pitch = pitch
+        event.velocity = velocity
+        event.data = data
+        self.timedEvents.append((time, len(self.timedEvents), event))
+
+    def add_note(self, start, length, channel, pitch, velocity,
+                 offAsNoteOn=False):
+        self.add(start, 'NOTE_ON', channel, pitch, velocity)
+        if offAsNoteOn:
+            self.add(start + length, 'NOTE_ON', channel, pitch, 0)
+        else:
+            self.add(start + length, 'NOTE_OFF', channel, pitch, 0)
+
+    def build(self):
+        # Sort by time (keeping insertion order for ties) and put a
+        # DeltaTime in front of every event
+        time = 0
+        for eventTime, _, event in sorted(self.timedEvents,
+                                          key=lambda e: e[:2]):
+            deltaTime = midi.DeltaTime(self.track)
+            deltaTime.time = eventTime - time
+            time = eventTime
+            self.track.events.append(deltaTime)
+            self.track.events.append(event)
+        return self.track
+
+def make_file(trackBuilders):
+    midiFile = midi.MidiFile()
+    midiFile.format = 1
+    midiFile.ticksPerQuarterNote = TICKS_PER_QUARTER_NOTE
+    midiFile.tracks = [builder.build() for builder in trackBuilders]
+    return midiFile
+
+def make_tempo_track(bpm=120):
+    builder = TrackBuilder(0)
+    mpqn = int(60000000 / bpm)
+    builder.add(0, 'SET_TEMPO', data=mpqn.to_bytes(3, byteorder='big'))
+    builder.add(0, 'TIME_SIGNATURE', data=bytes([4, 2, 24, 8]))
+    return builder
+
+def add_melody(builder, rng, channel, noteCount, lengths, start=0,
+               offAsNoteOn=False):
+    time = start
+    pitch = rng.randint(LOWEST_PITCH + 12, HIGHEST_PITCH - 12)
+    for i in range(noteCount):
+        # Random walk, so the line sounds (and compacts) like a melody
+        pitch = min(max(pitch + rng.randint(-4, 4), LOWEST_PITCH),
+                    HIGHEST_PITCH)
+        length = rng.choice(lengths)
+        builder.add_note(time, length, channel, pitch, rng.randint(40, 127),
+                         offAsNoteOn)
+        time += length
+    return time
+
+def channel_for_track(t):
+    # Use every channel except 10 (drums)
+    channel = (t % 15) + 1
+    if channel >= 10:
+        channel += 1
+    return channel
+
+def many_tracks(rng, scale=1):
+    builders = [make_tempo_track()]
+    for t in range(48):
+        builder = TrackBuilder(t + 1)
+        builder.add(0, 'SEQUENCE_TRACK_NAME', data=b'track %d' % t)
+        builder.add(0, 'PROGRAM_CHANGE', channel_for_track(t), data=t % 128)
+        add_melody(builder, rng, channel_for_track(t), 250 * scale,
+                   [240, 480, 960])
+        builders.append(builder)
+    return make_file(builders)
+
+def dense_runs(rng, scale=1):
+    builders = [make_tempo_track(bpm=90)]
+    for t in range(4):
+        builder = TrackBuilder(t + 1)
+        add_melody(builder, rng, t + 1, 8000 * scale, [THIRTY_SECOND_NOTE])
+        builders.append(builder)
+    return make_file(builders)
+
+def heavy_running_status(rng, scale=1):
+    # Note-offs written as zero-velocity note-ons, plus a stream of
+    # controller changes, so that (when written with runningStatus=True)
+    # almost every event relies on running status
+    builders = [make_tempo_track()]
+    for t in range(4):
+        builder = TrackBuilder(t + 1)
+        end = add_melody(builder, rng, t + 1, 6000 * scale,
+                         [THIRTY_SECOND_NOTE, THIRTY_SECOND_NOTE * 2],
+                         offAsNoteOn=True)
+        for time in range(0, end, THIRTY_SECOND_NOTE // 2):
+            builder.add(time, 'CONTROLLER_CHANGE', t + 1, 1,
+                        rng.randint(0, 127))
+        builders.append(builder)
+    return make_file(builders)
+
+def big_sysex(rng, scale=1):
+    builders = [make_tempo_track()]
+    builder = TrackBuilder(1)
+    for i in range(32 * scale):
+        payload = bytes(rng.randrange(0x80) for b in range(32 * 1024))
+        builder.add(i * TICKS_PER_QUARTER_NOTE, 'F0_SYSEX_EVENT',
+                    data=payload + b'\xf7')
+    builders.append(builder)
+    for t in range(2):
+        builder = TrackBuilder(t + 2)
+        add_melody(builder, rng, t + 1, 500 * scale, [120, 240])
+        builders.append(builder)
+    return make_file(builders)
+
+def long_silences(rng, scale=1):
+    builders = [make_tempo_track()]
+    for t in range(3):
+        builder = TrackBuilder(t + 1)
+        time = 0
+        for phrase in range(20 * scale):
+            time = add_melody(builder, rng, t + 1, 16, [120, 240], time)
+            # Rest for 16 to 64 bars
+            time += rng.randint(16, 64) * 4 * TICKS_PER_QUARTER_NOTE
+        builders.append(builder)
+    return make_file(builders)
+
+def karaoke(rng, scale=1):
+    builders = [make_tempo_track()]
+    words = [b'la', b'doo', b'bee', b'bop', b'shoo', b'wop']
+    for t in range(2):
+        builder = TrackBuilder(t + 1)
+        end = add_melody(builder, rng, t + 1, 3000 * scale, [120, 240, 480])
+        for time in range(0, end, 120):
+            builder.add(time, 'LYRIC', data=rng.choice(words))
+            builder.add(time, 'TEXT_EVENT', data=b' ' * rng.randint(8, 64))
+        builders.append(builder)
+    return make_file(builders)
+
+# name -> (generator, write with running status)
+CORPUS = {
+    'many_tracks': (many_tracks, False),
+    'dense_runs': (dense_runs, False),
+    'heavy_running_status': (heavy_running_status, True),
+    'big_sysex': (big_sysex, False),
+    'long_silences': (long_silences, False),
+    'karaoke': (karaoke, False),
+}
+
+# Generate the named corpus file and return it as MIDI file bytes
+def make_corpus_file(name, seed=0, scale=1):
+    generator, runningStatus = CORPUS[name]
+    midiFile = generator(random.Random(seed), scale)
+    return midiFile.writestr(runningStatus)
+
+# Write every corpus file to the given directory and return their paths
+def write_corpus(directory, seed=0, scale=1):
+    paths = []
+    for name in CORPUS:
+        path = os.path.join(directory, name + '.mid')
+        with open(path, 'wb') as fh:
+            fh.write(make_corpus_file(name, seed, scale))
+        paths.append(path)
+    return paths
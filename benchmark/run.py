@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Benchmark harness: times each stage of a MIDI -> PICO-8 conversion
+# (MidiFile.read, Translator.analyze, Translator.get_sfx_lists and cart
+# writing) on the given MIDI files and/or the synthetic corpus, and reports
+# time, throughput and peak memory for each.
+#
+# Run from the top of the repository, e.g.:
+#     python -m benchmark.run --corpus
+#     python -m benchmark.run bwv578.mid invent13.mid --repeat 5
+
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import awyeah
+from midi import midi
+from pico8 import util
+from translator import translator
+
+from . import corpus
+
+STAGES = ['read', 'analyze', 'get_sfx_lists', 'write_cart']
+
+# The state of one conversion, advanced one stage at a time
+class Conversion:
+    def __init__(self, data, readOptions):
+        self.data = data
+        self.readOptions = readOptions
+        songConfig = awyeah.make_song_config()
+        args = awyeah.make_arg_parser(songConfig).parse_args(['benchmark'])
+        self.settings = awyeah.make_translator_settings(args)
+        self.songConfig = songConfig
+        self.midiFile = None
+        self.translator = None
+        self.tracks = None
+
+    def run_stage(self, stage):
+        if stage == 'read':
+            self.midiFile = midi.MidiFile()
+            self.midiFile.readstr(self.data, **self.readOptions)
+        elif stage == 'analyze':
+            self.translator = translator.Translator(
+                    self.midiFile, self.settings)
+            self.translator.analyze()
+        elif stage == 'get_sfx_lists':
+            self.tracks = self.translator.get_sfx_lists()
+        elif stage == 'write_cart':
+            cart = awyeah.make_cart(self.tracks, self.songConfig)
+            cart.to_p8_file(io.StringIO())
+
+# Count the events and the (paired) notes in a MIDI file, for the throughput
+# figures
+def count_events_and_notes(data):
+    midiFile = midi.MidiFile()
+    midiFile.readstr(data, columnar=True)
+    eventCount = sum(len(track.columns) for track in midiFile.tracks)
+    noteCount = sum(len(channel.noteTable())
+                    for track in midiFile.tracks
+                    for channel in track.channels)
+    return eventCount, noteCount
+
+# Return {stage: (best seconds, highest peak bytes or None)}, stopping at the
+# first stage that fails; a failed stage's entry is the exception
+def measure(data, readOptions, repeat, traceMemory):
+    results = {}
+    for r in range(repeat):
+        conversion = Conversion(data, readOptions)
+        for stage in STAGES:
+            if traceMemory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            try:
+                conversion.run_stage(stage)
+            except Exception as e:
+                results[stage] = e
+                break
+            finally:
+                elapsed = time.perf_counter() - start
+                if traceMemory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                else:
+                    peak = None
+
+            # Time is best-of-N, but memory is the worst run's peak
+            if stage in results:
+                best, bestPeak = results[stage]
+                elapsed = min(best, elapsed)
+                if peak != None:
+                    peak = max(bestPeak, peak)
+            results[stage] = (elapsed, peak)
+    return results
+
+def format_result(result, count, unit):
+    if isinstance(result, Exception):
+        return 'FAILED ({0}: {1})'.format(type(result).__name__, result)
+    seconds, peak = result
+    text = '{0:9.3f} s'.format(seconds)
+    if count and seconds > 0:
+        text += '  {0:>12,.0f} {1}/s'.format(count / seconds, unit)
+    if peak != None:
+        text += '  peak {0:8.1f} MiB'.format(peak / (1024 * 1024))
+    return text
+
+# Time (and optionally measure the memory of) every stage of converting one
+# MIDI file, and print the results
+def benchmark_file(path, readOptions, repeat, memory):
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    eventCount, noteCount = count_events_and_notes(data)
+
+    print('{0}: {1:,} bytes, {2:,} events, {3:,} notes'.format(
+        os.path.basename(path), len(data), eventCount, noteCount))
+
+    # Timing and memory are measured in separate runs, since tracing
+    # allocations slows everything down
+    timings = measure(data, readOptions, repeat, traceMemory=False)
+    if memory:
+        peaks = measure(data, readOptions, 1, traceMemory=True)
+    else:
+        peaks = {}
+
+    for stage in STAGES:
+        if not stage in timings:
+            continue
+        result = timings[stage]
+        peak = peaks.get(stage)
+        if not isinstance(result, Exception) and isinstance(peak, tuple):
+            result = (result[0], peak[1])
+        label = stage
+        if stage == 'read' and readOptions.get('lazy'):
+            # A lazy read only indexes the MTrk chunks; the tracks are
+            # decoded by the analysis, so there is no throughput to report
+            label = 'read (index)'
+            count, unit = None, None
+        elif stage == 'read':
+            count, unit = eventCount, 'events'
+        else:
+            count, unit = noteCount, 'notes'
+        print('  {0:<14} {1}'.format(label, format_result(result, count,
+                                                           unit)))
+
+def main():
+    argParser = argparse.ArgumentParser(
+            description="Benchmark MIDI parsing, translation and cart " +
+                        "writing")
+    argParser.add_argument(
+            'midiPaths',
+            help="MIDI files to benchmark",
+            nargs='*')
+    argParser.add_argument(
+            '--corpus',
+            help="Also benchmark the generated synthetic corpus",
+            action='store_true')
+    argParser.add_argument(
+            '--corpus-only',
+            help="Only benchmark these files from the synthetic corpus",
+            nargs='+',
+            choices=sorted(corpus.CORPUS.keys()))
+    argParser.add_argument(
+            '--scale',
+            help="Size multiplier for the synthetic corpus",
+            type=int,
+            default=1)
+    argParser.add_argument(
+            '--seed',
+            help="Random seed for the synthetic corpus",
+            type=int,
+            default=0)
+    argParser.add_argument(
+            '--repeat',
+            help="Number of runs to take the best time of",
+            type=int,
+            default=1)
+    argParser.add_argument(
+            '--no-memory',
+            help="Don't measure peak memory (saves a traced run per file)",
+            action='store_true')
+    argParser.add_argument(
+            '--columnar',
+            help="Read MIDI files into the columnar event store",
+            action='store_true')
+    argParser.add_argument(
+            '--lazy',
+            help="Only index the MIDI tracks when reading, and decode each " +
+                 "one when the translator first uses it (during analysis)",
+            action='store_true')
+    argParser.add_argument(
+            '--keep-all',
+            help="Read all MIDI event types, not only the ones the " +
+                 "translator uses",
+            action='store_true')
+    args = argParser.parse_args()
+
+    # Keep the translator's messages out of the report
+    util.set_verbosity(util.VERBOSITY_QUIET)
+
+    readOptions = {'columnar': args.columnar, 'lazy': args.lazy}
+    if not args.keep_all:
+        readOptions['keep'] = translator.Translator.MIDI_EVENT_TYPES
+
+    paths = list(args.midiPaths)
+    with tempfile.TemporaryDirectory() as corpusDir:
+        if args.corpus or args.corpus_only:
+            for name in (args.corpus_only or corpus.CORPUS.keys()):
+                path = os.path.join(corpusDir, name + '.mid')
+                with open(path, 'wb') as fh:
+                    fh.write(corpus.make_corpus_file(name, args.seed,
+                                                     args.scale))
+                paths.append(path)
+
+        if len(paths) == 0:
+            argParser.error('no MIDI files given (use --corpus for the ' +
+                            'synthetic corpus)')
+
+        for path in paths:
+            benchmark_file(path, readOptions, args.repeat,
+                           not args.no_memory)
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ Helpful MIDI info:
 http://crystal.apana.org.au/ghansper/midi_introduction/midi_file_form... 
 http://www.argonet.co.uk/users/lenny/midi/mfile.html 
 """ 
-import sys, string, types, io
+import sys, string, types, io, heapq
+from array import array
 debugflag = 0 
 #import io
 #sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
@@ -36,23 +37,35 @@ def getVariableLengthNumber(tmpstr):
         sum = (sum << 7) + (x & 0x7F) 
         if not (x & 0x80): 
             return sum, tmpstr[i:] 
+# readNumber() and readVariableLengthNumber() are the offset-based versions
+# of the two functions above: instead of returning the rest of the buffer
+# (which copies it), they return the offset just past the number.
+def readNumber(buf, pos, length):
+    sum = 0
+    for i in range(pos, pos + length):
+        sum = (sum << 8) + buf[i]
+    return sum, pos + length
+def readVariableLengthNumber(buf, pos):
+    sum = 0
+    while 1:
+        x = buf[pos]
+        pos = pos + 1
+        sum = (sum << 7) + (x & 0x7F)
+        if not (x & 0x80):
+            return sum, pos
 def putNumber(num, length): 
     # MIDI uses big-endian for everything 
-    lst = [ ] 
-    for i in range(length): 
-        n = 8 * (length - 1 - i) 
-        lst.append(chr((num >> n) & 0xFF)) 
-    return str([lst, ""]) 
+    return (num & ((1 << (8 * length)) - 1)).to_bytes(length, "big")
 def putVariableLengthNumber(x): 
-    lst = [ ] 
+    lst = bytearray()
     while 1: 
         y, x = x & 0x7F, x >> 7 
-        lst.append(chr(y + 0x80)) 
+        lst.append(y + 0x80)
         if x == 0: 
             break 
     lst.reverse() 
-    lst[-1] = chr(ord(lst[-1]) & 0x7f) 
-    return str([lst, ""]) 
+    lst[-1] = lst[-1] & 0x7f
+    return bytes(lst)
 class EnumException(Exception): 
     pass 
 class Enumeration: 
@@ -128,14 +141,68 @@ metaEvents = Enumeration([("SEQUENCE_NUMBER", 0x00),
                           ("TIME_SIGNATURE", 0x58), 
                           ("KEY_SIGNATURE", 0x59), 
                           ("SEQUENCER_SPECIFIC_META_EVENT", 0x7F)]) 
-# runningStatus appears to want to be an attribute of a MidiTrack. But 
-# it doesn't seem to do any harm to implement it as a global. 
-runningStatus = None 
+# Integer codes for every event type, used by the columnar event store.
+# eventTypeNames[code] is the same string as MidiEvent.type.
+eventTypeNames = ([channelVoiceMessages.whatis(v)
+                   for v in sorted(channelVoiceMessages.reverseLookup)] +
+                  [channelModeMessages.whatis(v)
+                   for v in sorted(channelModeMessages.reverseLookup)] +
+                  ["F0_SYSEX_EVENT", "F7_SYSEX_EVENT"] +
+                  [metaEvents.whatis(v)
+                   for v in sorted(metaEvents.reverseLookup)])
+eventTypeCodes = dict((name, code) for code, name in enumerate(eventTypeNames))
+eventTypes = Enumeration(list(eventTypeCodes.items()))
+# statusTable[statusByte] says how to decode an event with that status byte,
+# as a (kind, type code, channel) tuple, or None if the byte is not a valid
+# status. 0xBn is always CONTROLLER_CHANGE; channel mode messages are just
+# controllers 0x78-0x7F and are reported as such.
+kindTwoBytes, kindOneByte, kindSysex, kindMeta = range(4)
+statusTable = [None] * 256
+for y in channelVoiceMessages.reverseLookup:
+    code = eventTypeCodes[channelVoiceMessages.whatis(y)]
+    if code == eventTypes.PROGRAM_CHANGE or \
+       code == eventTypes.CHANNEL_KEY_PRESSURE:
+        kind = kindOneByte
+    else:
+        kind = kindTwoBytes
+    for channel in range(16):
+        statusTable[y + channel] = (kind, code, channel + 1)
+statusTable[0xF0] = (kindSysex, eventTypes.F0_SYSEX_EVENT, None)
+statusTable[0xF7] = (kindSysex, eventTypes.F7_SYSEX_EVENT, None)
+statusTable[0xFF] = (kindMeta, None, None)
+# metaTypeTable[metaType] is the type code of that meta event, or None
+metaTypeTable = [None] * 256
+for z in metaEvents.reverseLookup:
+    metaTypeTable[z] = eventTypeCodes[metaEvents.whatis(z)]
+noteOffCode = eventTypes.NOTE_OFF
+noteOnCode = eventTypes.NOTE_ON
+def keepTable(keep):
+    """Turn a collection of event type names (or type codes) into a list
+    indexed by type code saying whether to keep that type. None means keep
+    everything."""
+    if keep is None:
+        return None
+    table = [False] * len(eventTypeNames)
+    for t in keep:
+        if isinstance(t, str):
+            t = eventTypeCodes[t]
+        table[t] = True
+    return table
 class MidiEvent: 
     def __init__(self, track): 
         self.track = track 
         self.time = None 
         self.channel = self.pitch = self.velocity = self.data = None 
+        self.code = None
+    # The integer type code (see eventTypes) is what is stored; the type
+    # name is derived from it
+    @property
+    def type(self):
+        if self.code is not None:
+            return eventTypeNames[self.code]
+    @type.setter
+    def type(self, name):
+        self.code = eventTypeCodes[name]
     def __cmp__(self, other): 
         # assert self.time != None and other.time != None 
         return cmp(self.time, other.time) 
@@ -149,85 +216,85 @@ class MidiEvent:
             if getattr(self, attrib) != None: 
                 r = r + ", " + attrib + "=" + repr(getattr(self, attrib)) 
         return r + ">" 
-    def read(self, time, tmpstr): 
-        global runningStatus
-        self.time = time 
-        #print('%02x' % tmpstr[0])
+    def read(self, time, buf, pos=0):
+        """Decode the event starting at buf[pos] and return the offset of
+        the byte following it."""
+        self.time = time
+        #print('%02x' % buf[pos])
         # do we need to use running status? 
-        if not (tmpstr[0] & 0x80): 
-            tmpstr = bytes([runningStatus]) + tmpstr
-        runningStatus = x = tmpstr[0]
-        y = x & 0xF0 
-        z = tmpstr[1] 
-        if channelVoiceMessages.has_value(y): 
-            self.channel = (x & 0x0F) + 1 
-            self.type = channelVoiceMessages.whatis(y) 
-            if (self.type == "PROGRAM_CHANGE" or 
-                self.type == "CHANNEL_KEY_PRESSURE"): 
-                self.data = z 
-                return tmpstr[2:] 
-            else: 
-                self.pitch = z 
-                self.velocity = tmpstr[2] 
-                channel = self.track.channels[self.channel - 1] 
-                if (self.type == "NOTE_OFF" or 
-                    (self.velocity == 0 and self.type == "NOTE_ON")): 
-                    channel.noteOff(self.pitch, self.time) 
-                elif self.type == "NOTE_ON": 
-                    channel.noteOn(self.pitch, self.time, self.velocity) 
-                return tmpstr[3:] 
-        elif y == 0xB0 and channelModeMessages.has_value(z): 
-            self.channel = (x & 0x0F) + 1 
-            self.type = channelModeMessages.whatis(z) 
-            if self.type == "LOCAL_CONTROL": 
-                self.data = (tmpstr[2] == 0x7F) 
-            elif self.type == "MONO_MODE_ON": 
-                self.data = tmpstr[2] 
-            return tmpstr[3:] 
-        elif x == 0xF0 or x == 0xF7: 
-            self.type = {0xF0: "F0_SYSEX_EVENT", 
-                         0xF7: "F7_SYSEX_EVENT"}[x] 
-            length, tmpstr = getVariableLengthNumber(tmpstr[1:]) 
-            self.data = tmpstr[:length] 
-            return tmpstr[length:] 
-        elif x == 0xFF: 
-            if not metaEvents.has_value(z): 
-                print("Unknown meta event: FF %02X" % z) 
+        x = buf[pos]
+        if x & 0x80:
+            self.track.runningStatus = x
+            pos = pos + 1
+        else:
+            x = self.track.runningStatus
+        entry = statusTable[x]
+        if entry is None:
+            raise Exception("Unknown midi event type")
+        kind, code, self.channel = entry
+        if kind == kindTwoBytes:
+            self.code = code
+            self.pitch = buf[pos]
+            self.velocity = buf[pos + 1]
+            if code == noteOnCode or code == noteOffCode:
+                self.trackNote()
+            return pos + 2
+        elif kind == kindOneByte:
+            self.code = code
+            self.data = buf[pos]
+            return pos + 1
+        elif kind == kindSysex:
+            self.code = code
+            length, pos = readVariableLengthNumber(buf, pos)
+        else:
+            self.code = metaTypeTable[buf[pos]]
+            if self.code is None:
+                print("Unknown meta event: FF %02X" % buf[pos])
                 sys.stdout.flush() 
                 raise Exception("Unknown midi event type") 
-            self.type = metaEvents.whatis(z) 
-            length, tmpstr = getVariableLengthNumber(tmpstr[2:]) 
-            self.data = tmpstr[:length] 
-            return tmpstr[length:] 
-        raise Exception("Unknown midi event type") 
+            length, pos = readVariableLengthNumber(buf, pos + 1)
+        self.data = bytes(buf[pos:pos + length])
+        return pos + length
+    def trackNote(self):
+        """Tell the event's MidiChannel about a NOTE_ON or NOTE_OFF, so it
+        can pair them up."""
+        channel = self.track.channels[self.channel - 1]
+        if self.code == noteOffCode or self.velocity == 0:
+            channel.noteOff(self.pitch, self.time)
+        else:
+            channel.noteOn(self.pitch, self.time, self.velocity)
     def write(self): 
+        """Return the encoded event (without its delta time) as bytes. The
+        status byte is always written out; running status is not used."""
         sysex_event_dict = {"F0_SYSEX_EVENT": 0xF0, 
                             "F7_SYSEX_EVENT": 0xF7} 
         if channelVoiceMessages.hasattr(self.type): 
-            x = chr((self.channel - 1) + 
-                    getattr(channelVoiceMessages, self.type)) 
+            x = (self.channel - 1) + getattr(channelVoiceMessages, self.type)
             if (self.type != "PROGRAM_CHANGE" and 
                 self.type != "CHANNEL_KEY_PRESSURE"): 
-                data = chr(self.pitch) + chr(self.velocity) 
+                return bytes([x, self.pitch, self.velocity])
             else: 
-                data = chr(self.data) 
-            return x + data 
+                return bytes([x, self.data])
         elif channelModeMessages.hasattr(self.type): 
-            x = getattr(channelModeMessages, self.type) 
-            x = (chr(0xB0 + (self.channel - 1)) + 
-                 chr(x) + 
-                 chr(self.data)) 
-            return x 
+            if self.type == "LOCAL_CONTROL":
+                data = 0x7F if self.data else 0
+            elif self.data is None:
+                data = 0
+            else:
+                data = self.data
+            return bytes([0xB0 + (self.channel - 1),
+                          getattr(channelModeMessages, self.type),
+                          data])
         elif self.type in sysex_event_dict: 
-            tmpstr = chr(sysex_event_dict[self.type]) 
-            tmpstr = tmpstr + putVariableLengthNumber(len(self.data)) 
-            return tmpstr + str(self.data) 
+            return (bytes([sysex_event_dict[self.type]]) +
+                    putVariableLengthNumber(len(self.data)) +
+                    bytes(self.data))
         elif metaEvents.hasattr(self.type): 
-            tmpstr = chr(0xFF) + chr(getattr(metaEvents, self.type)) 
-            tmpstr = tmpstr + putVariableLengthNumber(len(self.data)) 
-            return tmpstr + str(self.data) 
+            return (bytes([0xFF, getattr(metaEvents, self.type)]) +
+                    putVariableLengthNumber(len(self.data)) +
+                    bytes(self.data))
         else: 
-            raise Exception("unknown midi event type: " + self.type) 
+            raise Exception("unknown midi event type: " + str(self.type))
 """ 
 register_note() is a hook that can be overloaded from a script that 
 imports this module. Here is how you might do that, if you wanted to 
@@ -251,64 +318,438 @@ those
     def __init__(self, track, index): 
         self.index = index 
         self.track = track 
+        # pitch -> [(keyDownTime, velocity), ...] of the notes sounding at
+        # that pitch, oldest first
         self.pitches = { } 
+        # A (time, pitch, velocity) tuple for every NOTE_ON and NOTE_OFF, in
+        # the order they occur, with a velocity of 0 for a NOTE_OFF (even
+        # one that doesn't end any note)
+        self.noteEvents = [ ]
+        # A (keyDownTime, keyUpTime, pitch, velocity) tuple for every
+        # completed note, in the order the notes ended; see noteTable()
+        self.notes = [ ]
     def __repr__(self): 
         return "<MIDI channel %d>" % self.index 
     def noteOn(self, pitch, time, velocity): 
-        self.pitches[pitch] = (time, velocity) 
+        self.noteEvents.append((time, pitch, velocity))
+        self.strike(pitch, time, velocity)
     def noteOff(self, pitch, time): 
-        if pitch in self.pitches: 
-            keyDownTime, velocity = self.pitches[pitch] 
+        self.noteEvents.append((time, pitch, 0))
+        note = self.release(pitch, time)
+        if note is not None:
+            self.notes.append(note)
+            keyDownTime, keyUpTime, pitch, velocity = note
             register_note(self.track.index, self.index, pitch, velocity, 
-                          keyDownTime, time) 
-            del self.pitches[pitch] 
+                          keyDownTime, keyUpTime) 
+    def strike(self, pitch, time, velocity):
+        """Start a note, without recording it in noteEvents."""
+        if pitch in self.pitches:
+            self.pitches[pitch].append((time, velocity))
+        else:
+            self.pitches[pitch] = [(time, velocity)]
+    def release(self, pitch, time):
+        """End the oldest note sounding at pitch, and return it as a
+        (keyDownTime, keyUpTime, pitch, velocity) tuple, without recording
+        it; or return None if no note is sounding at that pitch."""
+        # If the same pitch was struck more than once before being released,
+        # the releases are paired with the strikes first-in, first-out
+        starts = self.pitches.get(pitch)
+        if starts:
+            keyDownTime, velocity = starts.pop(0)
+            if not starts:
+                del self.pitches[pitch]
+            return (keyDownTime, time, pitch, velocity)
         # The case where the pitch isn't in the dictionary is illegal, 
         # I think, but we probably better just ignore it. 
+        return None
+    def noteTable(self):
+        """Return a (keyDownTime, keyUpTime, pitch, velocity) tuple for
+        every completed note, in the order the notes ended. The table is
+        built while the track is decoded; don't change it."""
+        return self.notes
 class DeltaTime(MidiEvent): 
     type = "DeltaTime" 
-    def read(self, oldtmpstr): 
-        self.time, newtmpstr = getVariableLengthNumber(oldtmpstr) 
-        return self.time, newtmpstr 
+    def read(self, buf, pos=0):
+        self.time, pos = readVariableLengthNumber(buf, pos)
+        return self.time, pos
     def write(self): 
         tmpstr = putVariableLengthNumber(self.time) 
         return tmpstr 
+def iterChunkEvents(buf, pos, end, keep=None, channelOrder=None):
+    """Decode the events in buf[pos:end] (the body of an MTrk chunk),
+    yielding one (time, type, channel, pitch, velocity, dataOffset,
+    dataLength) row per event, in the same layout as MidiTrackColumns.
+    No objects other than the row tuples are created. If keep is a
+    keepTable(), events of other types are skipped over without being
+    yielded; the times of the remaining events are unaffected. If
+    channelOrder is a list, the channel of every channel message, kept
+    or not, is appended to it the first time that channel appears."""
+    time = 0
+    status = None
+    # Bitmask of the channels already in channelOrder
+    seen = 0
+    while pos < end:
+        dt, pos = readVariableLengthNumber(buf, pos)
+        time = time + dt
+        x = buf[pos]
+        if x & 0x80:
+            status = x
+            pos = pos + 1
+        else:
+            x = status
+        entry = statusTable[x]
+        if entry is None:
+            raise Exception("Unknown midi event type")
+        kind, code, channel = entry
+        if channelOrder is not None and channel and not seen & (1 << channel):
+            seen |= 1 << channel
+            channelOrder.append(channel)
+        if kind == kindTwoBytes:
+            if keep is None or keep[code]:
+                yield (time, code, channel, buf[pos], buf[pos + 1], -1, -1)
+            pos = pos + 2
+        elif kind == kindOneByte:
+            if keep is None or keep[code]:
+                yield (time, code, channel, -1, -1, pos, -1)
+            pos = pos + 1
+        else:
+            if kind == kindMeta:
+                code = metaTypeTable[buf[pos]]
+                if code is None:
+                    raise Exception("Unknown midi event type")
+                pos = pos + 1
+            length, pos = readVariableLengthNumber(buf, pos)
+            if keep is None or keep[code]:
+                yield (time, code, 0, -1, -1, pos, length)
+            pos = pos + length
+def eventFromRow(track, buf, row):
+    """Build the MidiEvent for a row produced by iterChunkEvents()."""
+    time, code, channel, pitch, velocity, offset, length = row
+    e = MidiEvent(track)
+    e.time = time
+    e.code = code
+    if channel:
+        e.channel = channel
+    if pitch >= 0:
+        e.pitch = pitch
+    if velocity >= 0:
+        e.velocity = velocity
+    if offset >= 0:
+        if length >= 0:
+            e.data = buf[offset:offset + length]
+        else:
+            e.data = buf[offset]
+    return e
+class MidiTrackColumns:
+    """Columnar storage for the events of one track: one row per event,
+    held in parallel arrays instead of a DeltaTime and a MidiEvent object
+    per event. Missing values are stored as 0 (channel) or -1 (pitch,
+    velocity, dataOffset). Payloads are not copied; dataOffset and
+    dataLength point into the buffer the file was read from."""
+    def __init__(self):
+        self.buf = None
+        self.time = array("L")          # absolute tick
+        self.type = array("B")          # index into eventTypeNames
+        self.channel = array("B")       # 1-16, or 0
+        # Signed shorts, so that -1 can stand for "missing" next to any data
+        # byte value, even a malformed one of 0x80 or more
+        self.pitch = array("h")
+        self.velocity = array("h")
+        self.dataOffset = array("l")
+        self.dataLength = array("l")    # -1 for single-byte integer data
+    def __len__(self):
+        return len(self.time)
+    def append(self, time, type, channel=0, pitch=-1, velocity=-1,
+               dataOffset=-1, dataLength=-1):
+        self.time.append(time)
+        self.type.append(type)
+        self.channel.append(channel)
+        self.pitch.append(pitch)
+        self.velocity.append(velocity)
+        self.dataOffset.append(dataOffset)
+        self.dataLength.append(dataLength)
+    def read(self, buf, pos, end, keep=None):
+        """Decode the events in buf[pos:end] into the columns, keeping only
+        the types allowed by the keepTable() keep."""
+        self.buf = buf
+        append = self.append
+        for row in iterChunkEvents(buf, pos, end, keep):
+            append(*row)
+    def row(self, i):
+        return (self.time[i], self.type[i], self.channel[i], self.pitch[i],
+                self.velocity[i], self.dataOffset[i], self.dataLength[i])
+    def event(self, track, i):
+        """Build the MidiEvent for row i."""
+        return eventFromRow(track, self.buf, self.row(i))
+    def events(self, track):
+        """Build the legacy list of alternating DeltaTime and MidiEvent
+        objects."""
+        events = [ ]
+        time = 0
+        for i in range(len(self)):
+            delta_t = DeltaTime(track)
+            delta_t.time = self.time[i] - time
+            time = self.time[i]
+            events.append(delta_t)
+            events.append(self.event(track, i))
+        return events
 class MidiTrack: 
     def __init__(self, index): 
         self.index = index 
-        self.events = [ ] 
-        self.channels = [ ] 
+        # Running status is per-track parser state, so separate tracks (and
+        # separate files) can be parsed at the same time
+        self.runningStatus = None
+        self._columns = None
+        self._events = None
+        self._channels = None
+        # The channels (1-16) used by the track's channel messages, in order
+        # of first appearance, recorded while decoding (including channels
+        # that only appear in events that keep filtered out)
+        self._channelOrder = None
+        # (buffer, offset, columnar, keep) of a chunk that has been indexed
+        # by readlazy() but not decoded yet
+        self._chunk = None
         self.length = 0 
-        for i in range(16): 
-            self.channels.append(MidiChannel(self, i+1)) 
-    def read(self, tmpstr): 
+    def decode(self):
+        """Decode the chunk recorded by readlazy(), if it hasn't been
+        decoded yet."""
+        if self._chunk is not None:
+            buf, pos, columnar, keep = self._chunk
+            self._chunk = None
+            if columnar:
+                self.readcolumns(buf, pos, keep)
+            else:
+                self.read(buf, pos, keep)
+    @property
+    def columns(self):
+        self.decode()
+        return self._columns
+    @columns.setter
+    def columns(self, columns):
+        self._columns = columns
+    @property
+    def events(self):
+        self.decode()
+        # When the track was read into columns, the event objects are only
+        # built the first time somebody asks for them
+        if self._events is None:
+            if self.columns is not None:
+                self._events = self.columns.events(self)
+            else:
+                self._events = [ ]
+        return self._events
+    @events.setter
+    def events(self, events):
+        self._events = events
+    @property
+    def channels(self):
+        # The channels' note events are recorded while decoding
+        self.decode()
+        if self._channels is None:
+            self._channels = [MidiChannel(self, i + 1) for i in range(16)]
+        return self._channels
+    @property
+    def channelOrder(self):
+        self.decode()
+        if self._channelOrder is None:
+            # The track wasn't read from bytes (e.g. its events were made
+            # by hand), so go by its events
+            order = [ ]
+            for e in self.iter_events():
+                if e.channel is not None and not e.channel in order:
+                    order.append(e.channel)
+            return order
+        return self._channelOrder
+    def iter_events(self):
+        """Yield the track's MidiEvents (without the DeltaTime entries) in
+        order; each event's time is its absolute tick. If the track has
+        not been decoded yet (see readlazy()), the events are decoded
+        straight from the chunk bytes one at a time, and neither
+        self.events nor self.columns is built."""
+        if self._chunk is not None:
+            buf, pos, columnar, keep = self._chunk
+            length, start = readNumber(buf, pos + 4, 4)
+            for row in iterChunkEvents(buf, start, start + length, keep):
+                yield eventFromRow(self, buf, row)
+        elif self._events is None and self._columns is not None:
+            for i in range(len(self._columns)):
+                yield self._columns.event(self, i)
+        else:
+            for e in self.events:
+                if e.type != "DeltaTime":
+                    yield e
+    def find_first_event(self, type):
+        """Return the first event of the given type (a name such as
+        "SET_TEMPO") in the track, or None. A track that has not been
+        decoded yet (see readlazy()) is searched straight from the chunk
+        bytes without decoding it, and a columnar one through its type
+        column; either way, only the event found is built."""
+        code = eventTypeCodes[type]
+        if self._chunk is not None:
+            buf, pos, columnar, keep = self._chunk
+            # Events the track would not keep once decoded can't be found
+            if keep is not None and not keep[code]:
+                return None
+            length, start = readNumber(buf, pos + 4, 4)
+            for row in iterChunkEvents(buf, start, start + length,
+                                       keepTable([code])):
+                return eventFromRow(self, buf, row)
+            return None
+        if self._events is None and self._columns is not None:
+            if code in self._columns.type:
+                return self._columns.event(self,
+                                           self._columns.type.index(code))
+            return None
+        for e in self.iter_events():
+            if e.code == code:
+                return e
+        return None
+    def iter_notes(self):
+        """Yield a (startTime, endTime, channel, pitch, velocity) tuple for
+        every note in the track. If the track has not been decoded yet (see
+        readlazy()), the notes are paired straight from the chunk bytes, in
+        the order they end, keeping only the notes that are sounding; no
+        event objects are built and self.events is not filled in.
+        Otherwise the notes are the ones each MidiChannel paired up while
+        the track was decoded (see MidiChannel.noteTable()), merged in the
+        order they end (in channel order when notes on different channels
+        end together)."""
+        if self._chunk is not None:
+            return self.iterChunkNotes()
+        def channelNotes(channel):
+            for start, end, pitch, velocity in channel.noteTable():
+                yield (start, end, channel.index, pitch, velocity)
+        return heapq.merge(*[channelNotes(c) for c in self.channels],
+                           key=lambda note: note[1])
+    def iterChunkNotes(self):
+        buf, pos, columnar, keep = self._chunk
+        length, start = readNumber(buf, pos + 4, 4)
+        # These channels only pair the notes; they are not self.channels
+        channels = [MidiChannel(self, i + 1) for i in range(16)]
+        # Only the note events the track would keep once decoded are used
+        codes = [code for code in (noteOnCode, noteOffCode)
+                 if keep is None or keep[code]]
+        for row in iterChunkEvents(buf, start, start + length,
+                                   keepTable(codes)):
+            time, code, channel, pitch, velocity = row[:5]
+            if code == noteOnCode and velocity > 0:
+                channels[channel - 1].strike(pitch, time, velocity)
+            else:
+                note = channels[channel - 1].release(pitch, time)
+                if note is not None:
+                    yield (note[0], time, channel, pitch, note[3])
+    def readlazy(self, buf, pos=0, columnar=False, keep=None):
+        """Record where the MTrk chunk starting at buf[pos] is, without
+        decoding it; that happens the first time the track's events (or
+        columns) are used. Return the offset of the byte following the
+        chunk."""
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, start = readNumber(buf, pos + 4, 4)
+        self.length = length
+        self._chunk = (buf, pos, columnar, keep)
+        return start + length
+    def readcolumns(self, buf, pos=0, keep=None):
+        """Like read(), but store the events in a MidiTrackColumns instead
+        of creating event objects."""
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, pos = readNumber(buf, pos + 4, 4)
+        self.length = length
+        self.columns = columns = MidiTrackColumns()
+        columns.buf = buf
+        append = columns.append
+        channels = self.channels
+        self._channelOrder = [ ]
+        # Record the channels' note events in the same pass
+        for row in iterChunkEvents(buf, pos, pos + length, keep,
+                                   self._channelOrder):
+            append(*row)
+            code = row[1]
+            if code == noteOnCode and row[4] > 0:
+                channels[row[2] - 1].noteOn(row[3], row[0], row[4])
+            elif code == noteOffCode or code == noteOnCode:
+                channels[row[2] - 1].noteOff(row[3], row[0])
+        return pos + length
+    def read(self, buf, pos=0, keep=None):
+        """Decode the MTrk chunk starting at buf[pos] and return the offset
+        of the byte following the chunk. If keep is a keepTable(), only
+        events of those types are kept; the DeltaTime before each kept
+        event covers any skipped events too."""
         time = 0 
-        assert tmpstr[:4] == b"MTrk" 
-        length, tmpstr = getNumber(tmpstr[4:], 4) 
+        assert buf[pos:pos + 4] == b"MTrk"
+        length, pos = readNumber(buf, pos + 4, 4)
         self.length = length 
-        mytmpstr = tmpstr[:length] 
-        remainder = tmpstr[length:] 
-        while mytmpstr: 
+        self.runningStatus = None
+        end = pos + length
+        append = self.events.append
+        self._channelOrder = channelOrder = [ ]
+        if keep is not None:
+            for row in iterChunkEvents(buf, pos, end, keep, channelOrder):
+                delta_t = DeltaTime(self)
+                delta_t.time = row[0] - time
+                time = row[0]
+                append(delta_t)
+                e = eventFromRow(self, buf, row)
+                if e.code == noteOnCode or e.code == noteOffCode:
+                    e.trackNote()
+                append(e)
+            return end
+        while pos < end:
             delta_t = DeltaTime(self) 
-            dt, mytmpstr = delta_t.read(mytmpstr) 
+            dt, pos = delta_t.read(buf, pos)
             time = time + dt 
-            self.events.append(delta_t) 
+            append(delta_t)
             e = MidiEvent(self) 
-            mytmpstr = e.read(time, mytmpstr) 
-            self.events.append(e) 
-        return remainder 
-    def write(self): 
-        time = self.events[0].time 
-        # build tmpstr using MidiEvents 
-        tmpstr = "" 
+            pos = e.read(time, buf, pos)
+            append(e)
+            if e.channel is not None and not e.channel in channelOrder:
+                channelOrder.append(e.channel)
+        return end
+    def write(self, runningStatus=False):
+        return bytes(self.writeinto(bytearray(), runningStatus))
+    def writeinto(self, out, runningStatus=False):
+        """Append the encoded MTrk chunk to the bytearray out and return
+        it. An END_OF_TRACK event is added if the track doesn't end with
+        one (e.g. because events were filtered out). If runningStatus is
+        True, a channel message's status byte is left out when it is the
+        same as the previous one's."""
+        start = len(out)
+        out += b"MTrk\0\0\0\0"
+        last = None
+        status = None
         for e in self.events: 
-            tmpstr = tmpstr + e.write() 
-        return "MTrk" + putNumber(len(tmpstr), 4) + tmpstr 
+            data = e.write()
+            last = e.type
+            if runningStatus and last != "DeltaTime":
+                if data[0] >= 0xF0:
+                    # sysex and meta events cancel running status
+                    status = None
+                elif data[0] == status:
+                    data = data[1:]
+                else:
+                    status = data[0]
+            out += data
+        if last != "END_OF_TRACK":
+            if last != "DeltaTime":
+                out += b"\x00"
+            out += b"\xff\x2f\x00"
+        # Fill in the chunk length now that it is known
+        out[start + 4:start + 8] = putNumber(len(out) - start - 8, 4)
+        return out
     def __repr__(self): 
         r = "<MidiTrack %d -- %d events\n" % (self.index, 
 len(self.events)) 
         for e in self.events: 
             r = r + "    " + repr(e) + "\n" 
         return r + "  >" 
+def readTrackChunk(index, chunk, columnar=False, keep=None):
+    """Parse one complete MTrk chunk into a new MidiTrack. This is a
+    module-level function so that it can be sent to a process pool."""
+    trk = MidiTrack(index)
+    if columnar:
+        trk.readcolumns(chunk, 0, keep)
+    else:
+        trk.read(chunk, 0, keep)
+    return trk
 class MidiFile: 
     def __init__(self): 
         self.file = None 
@@ -319,9 +760,9 @@ class MidiFile:
     def open(self, filename, attrib="rb"): 
         if filename == None: 
             if attrib in ["r", "rb"]: 
-                self.file = sys.stdin 
+                self.file = sys.stdin.buffer
             else: 
-                self.file = sys.stdout 
+                self.file = sys.stdout.buffer
         else: 
             self.file = open(filename, attrib) 
     def __repr__(self): 
@@ -332,17 +773,45 @@ class MidiFile:
     def close(self): 
         #self.file.close()
         pass
-    def read(self): 
-        self.readstr(self.file.read()) 
-    def readstr(self, tmpstr): 
+    def read(self, columnar=False, parallel=False, lazy=False, keep=None):
+        self.readstr(self.file.read(), columnar, parallel, lazy, keep)
+    def readstr(self, tmpstr, columnar=False, parallel=False, lazy=False,
+                keep=None):
+        """Parse a whole MIDI file. If columnar is True, each track's events
+        are stored in its MidiTrackColumns (track.columns) and the legacy
+        track.events list is only built when it is first used (the
+        Translator never uses it).
+
+        If parallel is True, the MTrk chunks are parsed on a process pool
+        (threads would not help, since parsing is pure Python). parallel
+        may also be a concurrent.futures.Executor to run the parsing on.
+        Note that the register_note() hook is then called in the worker,
+        not in this process.
+
+        If lazy is True, only the offset and length of each MTrk chunk are
+        recorded up front, and a track is decoded the first time its events
+        (or channels) are used, so tracks that are never looked at cost
+        almost nothing; the Translator only decodes the tracks it
+        translates (see TranslatorSettings.midiTracks). A track that is
+        decoded costs the same as it would without lazy. lazy takes
+        precedence over parallel.
+
+        keep, if given, is a collection of the event type names (or
+        eventTypes codes) to keep, e.g. {"NOTE_ON", "NOTE_OFF"}. Events of
+        other types are skipped over by their length without being decoded
+        or stored; the times of the kept events are unaffected."""
+        # Everything below reads the buffer in place by offset; a bytes
+        # object indexes faster than a memoryview, so only convert once
+        if not isinstance(tmpstr, bytes):
+            tmpstr = bytes(tmpstr)
         assert tmpstr[:4] == b"MThd" 
-        length, tmpstr = getNumber(tmpstr[4:], 4) 
+        length, pos = readNumber(tmpstr, 4, 4)
         assert length == 6 
-        format, tmpstr = getNumber(tmpstr, 2) 
+        format, pos = readNumber(tmpstr, pos, 2)
         self.format = format 
         assert format == 0 or format == 1   # dunno how to handle 2 
-        numTracks, tmpstr = getNumber(tmpstr, 2) 
-        division, tmpstr = getNumber(tmpstr, 2) 
+        numTracks, pos = readNumber(tmpstr, pos, 2)
+        division, pos = readNumber(tmpstr, pos, 2)
         if division & 0x8000: 
             framesPerSecond = -((division >> 8) | -128) 
             ticksPerFrame = division & 0xFF 
@@ -352,23 +821,61 @@ class MidiFile:
             self.ticksPerSecond = ticksPerFrame * framesPerSecond 
         else: 
             self.ticksPerQuarterNote = division & 0x7FFF 
+        keep = keepTable(keep)
+        if lazy:
+            for i in range(numTracks):
+                trk = MidiTrack(i)
+                pos = trk.readlazy(tmpstr, pos, columnar, keep)
+                self.tracks.append(trk)
+            return
+        if parallel and numTracks > 1:
+            self.tracks = self.readtracksparallel(tmpstr, pos, numTracks,
+                                                  columnar, parallel, keep)
+            return
         for i in range(numTracks): 
             trk = MidiTrack(i)
             #print('Track#%d' % i);
-            tmpstr = trk.read(tmpstr) 
+            if columnar:
+                pos = trk.readcolumns(tmpstr, pos, keep)
+            else:
+                pos = trk.read(tmpstr, pos, keep)
             self.tracks.append(trk) 
+    def readtracksparallel(self, tmpstr, pos, numTracks, columnar, executor,
+                           keep=None):
+        # Find where each chunk starts and ends, then hand each worker only
+        # its own chunk
+        chunks = [ ]
+        for i in range(numTracks):
+            assert tmpstr[pos:pos + 4] == b"MTrk"
+            length, start = readNumber(tmpstr, pos + 4, 4)
+            chunks.append(tmpstr[pos:start + length])
+            pos = start + length
+        indexes = range(numTracks)
+        columnarFlags = [columnar] * numTracks
+        keeps = [keep] * numTracks
+        if executor is True:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor() as pool:
+                return list(pool.map(readTrackChunk, indexes, chunks,
+                                     columnarFlags, keeps))
+        return list(executor.map(readTrackChunk, indexes, chunks,
+                                 columnarFlags, keeps))
     def write(self): 
         self.file.write(self.writestr()) 
-    def writestr(self): 
+    def writestr(self, runningStatus=False):
+        """Encode the whole file as bytes, building it in a single
+        buffer. See MidiTrack.writeinto() for runningStatus."""
         division = self.ticksPerQuarterNote 
         # Don't handle ticksPerSecond yet, too confusing 
-        assert (division & 0x8000) == 0 
-        tmpstr = "MThd" + putNumber(6, 4) + putNumber(self.format, 2) 
-        tmpstr = tmpstr + putNumber(len(self.tracks), 2) 
-        tmpstr = tmpstr + putNumber(division, 2) 
+        assert division is not None and (division & 0x8000) == 0
+        out = bytearray(b"MThd")
+        out += putNumber(6, 4)
+        out += putNumber(self.format, 2)
+        out += putNumber(len(self.tracks), 2)
+        out += putNumber(division, 2)
         for trk in self.tracks: 
-            tmpstr = tmpstr + trk.write() 
-        return tmpstr 
+            trk.writeinto(out, runningStatus)
+        return bytes(out)
 def main(argv): 
     global debugflag 
     import getopt 
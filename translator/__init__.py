@@ -5,6 +5,7 @@ MIDI_TO_PICO8_PITCH_SUBTRAHEND = 36
 
 PICO8_MAX_PITCH = 63
 PICO8_MIN_NOTE_DURATION = 1
+PICO8_MAX_NOTE_DURATION = 255
 PICO8_NOTES_PER_SFX = 32
 
 PICO8_NUM_SFX = 64
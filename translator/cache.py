@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import tempfile
+from array import array
+
+from midi import midi
+
+from .notebuffer import NoteBuffer
+from .sfx import Sfx
+
+# Bump this whenever the format of the cache entries changes. Changes to the
+# translator's output are picked up by get_code_version().
+CACHE_FORMAT_VERSION = 4
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+CACHE_FILE_SUFFIX = '.translation'
+
+# A hash of the source code of the MIDI parser and the translator (found by
+# get_code_version), so that old cache entries are not used after either of
+# them changes
+codeVersion = None
+
+def get_code_version():
+    global codeVersion
+    if codeVersion == None:
+        h = hashlib.sha256()
+        for directory in (os.path.dirname(os.path.abspath(midi.__file__)),
+                          os.path.dirname(os.path.abspath(__file__))):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.py'):
+                    h.update(name.encode())
+                    with open(os.path.join(directory, name), 'rb') as fh:
+                        h.update(fh.read())
+        codeVersion = h.hexdigest()
+    return codeVersion
+
+def get_default_cache_dir():
+    cacheHome = os.environ.get('XDG_CACHE_HOME')
+    if not cacheHome:
+        cacheHome = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheHome, 'awyeah')
+
+# The result of translating a MIDI file: the analysis (base ticks, PICO-8 note
+# duration and quantization error) and the SFX list of each track
+class CachedTranslation:
+    def __init__(self, translator=None, sfxLists=None):
+        if translator != None:
+            self.baseTicks = translator.baseTicks
+            self.noteDuration = translator.noteDuration
+            self.quantizationError = translator.quantizationError
+        else:
+            self.baseTicks = None
+            self.noteDuration = None
+            self.quantizationError = None
+        self.sfxLists = sfxLists
+
+    # Return the translation as plain data (dicts, lists, numbers and None)
+    # that can be written as JSON
+    def to_data(self):
+        return {
+            'version': CACHE_FORMAT_VERSION,
+            'baseTicks': self.baseTicks,
+            'noteDuration': self.noteDuration,
+            'quantizationError': self.quantizationError,
+            'sfxLists': [[CachedTranslation.sfx_to_data(sfx) for sfx in sfxes]
+                         for sfxes in self.sfxLists]}
+
+    # Return an Sfx as plain data; its notes are stored as the raw values of
+    # its NoteBuffer's columns
+    @staticmethod
+    def sfx_to_data(sfx):
+        notes = sfx.notes
+        start = notes.start
+        stop = start + len(notes)
+        return {
+            'noteDuration': sfx.noteDuration,
+            'playLength': sfx.playLength,
+            'pitches': notes.pitches[start:stop].tolist(),
+            'volumes': notes.volumes[start:stop].tolist(),
+            'waveforms': notes.waveforms[start:stop].tolist(),
+            'effects': notes.effects[start:stop].tolist()}
+
+    # Make a CachedTranslation from the result of to_data(). Raise ValueError
+    # (or TypeError, KeyError or OverflowError) if the data is not a valid
+    # translation.
+    @staticmethod
+    def from_data(data):
+        if data['version'] != CACHE_FORMAT_VERSION:
+            raise ValueError('wrong cache format version')
+
+        translation = CachedTranslation()
+        translation.baseTicks = data['baseTicks']
+        translation.noteDuration = data['noteDuration']
+        translation.quantizationError = data['quantizationError']
+        translation.sfxLists = []
+        for sfxes in data['sfxLists']:
+            sfxList = []
+            for sfxData in sfxes:
+                notes = NoteBuffer(
+                        (array('b', sfxData['pitches']),
+                         array('b', sfxData['volumes']),
+                         array('b', sfxData['waveforms']),
+                         array('b', sfxData['effects'])))
+                if len(set(len(column) for column in notes.columns)) != 1:
+                    raise ValueError('note columns differ in length')
+
+                sfx = Sfx(notes)
+                sfx.noteDuration = int(sfxData['noteDuration'])
+                if sfxData['playLength'] != None:
+                    sfx.playLength = int(sfxData['playLength'])
+                sfxList.append(sfx)
+            translation.sfxLists.append(sfxList)
+
+        return translation
+
+# TranslationCache stores translations on disk, one JSON file per translation,
+# named after a hash of the MIDI file's contents and the TranslatorSettings it
+# was translated with. When the files add up to more than maxSize bytes, the
+# least recently used ones are deleted. The files hold only data (see
+# CachedTranslation.to_data), so a cache directory that someone else can write
+# to can at worst give a wrong cart, and never runs any code.
+class TranslationCache:
+    def __init__(self, directory=None, maxSize=DEFAULT_CACHE_SIZE):
+        if directory == None:
+            directory = get_default_cache_dir()
+        self.directory = directory
+        self.maxSize = maxSize
+
+    @staticmethod
+    def make_key(midiData, settings):
+        h = hashlib.sha256()
+        h.update(str(CACHE_FORMAT_VERSION).encode())
+        h.update(get_code_version().encode())
+        h.update(repr(sorted(vars(settings).items())).encode())
+        h.update(midiData)
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    # Return the CachedTranslation stored under key, or None. An entry that
+    # can't be decoded (e.g. because it was truncated) or isn't a valid
+    # translation is deleted; any other error reading it (an OSError) is
+    # raised, and the entry is kept.
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                translation = CachedTranslation.from_data(json.load(fh))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError, KeyError, OverflowError):
+            # json.JSONDecodeError and UnicodeDecodeError are ValueErrors
+            self.remove(path)
+            return None
+
+        # Mark this entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return translation
+
+    def put(self, key, translation):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temporary file first, so a reader never sees a partly
+        # written entry
+        fd, tmpPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump(translation.to_data(), fh, separators=(',', ':'))
+            os.replace(tmpPath, self.get_path(key))
+        except BaseException:
+            self.remove(tmpPath)
+            raise
+
+        self.evict()
+
+    # Delete the least recently used entries until the cache fits in maxSize
+    def evict(self):
+        entries = []
+        totalSize = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            totalSize += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalSize <= self.maxSize:
+                break
+            self.remove(path)
+            totalSize -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -2,6 +2,9 @@ import math
 from . import MIDI_TO_PICO8_PITCH_SUBTRAHEND
 
 class Note:
+    __slots__ = ('midiDuration', 'midiPitch', 'midiChannel', 'midiVelocity',
+                 'pitch', 'volume', 'waveform', 'effect')
+
     def __init__(self, event=None):
         # MIDI properties
         self.midiDuration = 0
@@ -14,12 +17,14 @@ class Note:
         self.volume = 0
         self.waveform = None
         self.effect = None
-        self.length = 0
 
         if event != None:
-            self.midiPitch = event.pitch
-            self.midiChannel = event.channel
-            self.midiVelocity = event.velocity
-            self.pitch = event.pitch - MIDI_TO_PICO8_PITCH_SUBTRAHEND
-            self.volume = math.floor((event.velocity / 127) * 7)
+            self.set_midi_note(event.pitch, event.channel, event.velocity)
+
+    def set_midi_note(self, pitch, channel, velocity):
+        self.midiPitch = pitch
+        self.midiChannel = channel
+        self.midiVelocity = velocity
+        self.pitch = pitch - MIDI_TO_PICO8_PITCH_SUBTRAHEND
+        self.volume = math.floor((velocity / 127) * 7)
 
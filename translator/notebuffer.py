@@ -0,0 +1,143 @@
+from array import array
+from collections import Counter
+
+# Values stored in place of None
+NO_PITCH = -128
+NO_VALUE = -1
+
+# NoteBuffer holds a sequence of PICO-8 notes as parallel arrays (pitch,
+# volume, waveform, effect and length) instead of a list of Note objects.
+# Slicing a NoteBuffer gives a view onto the same arrays without copying them.
+#
+# The length column is only needed when each row is a run of several PICO-8
+# notes (see Translator.get_pico_notes). A buffer made with lengths=False has
+# one row per PICO-8 note, as the notes of an SFX do, and leaves the column
+# out; every note's length is then 1.
+class NoteBuffer:
+    def __init__(self, columns=None, start=0, stop=None, lengths=True):
+        if columns == None:
+            columns = (
+                array('b'),     # pitch
+                array('b'),     # volume
+                array('b'),     # waveform
+                array('b'),     # effect
+                array('l'))     # length
+            if not lengths:
+                columns = columns[:4]
+        self.columns = columns
+        (self.pitches, self.volumes, self.waveforms,
+         self.effects) = columns[:4]
+        if len(columns) > 4:
+            self.lengths = columns[4]
+        else:
+            self.lengths = None
+
+        # A view covers [start, stop) of the arrays; a buffer that owns its
+        # arrays has a stop of None, meaning "to the end"
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        if self.stop == None:
+            return len(self.pitches) - self.start
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('NoteBuffers can only be sliced')
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError('NoteBuffer slices must be contiguous')
+        return NoteBuffer(self.columns, self.start + start,
+                          self.start + max(start, stop))
+
+    def pitch(self, i):
+        pitch = self.pitches[self.start + i]
+        if pitch == NO_PITCH:
+            return None
+        return pitch
+
+    def volume(self, i):
+        return self.volumes[self.start + i]
+
+    def waveform(self, i):
+        waveform = self.waveforms[self.start + i]
+        if waveform == NO_VALUE:
+            return None
+        return waveform
+
+    def effect(self, i):
+        effect = self.effects[self.start + i]
+        if effect == NO_VALUE:
+            return None
+        return effect
+
+    def length(self, i):
+        if self.lengths == None:
+            return 1
+        return self.lengths[self.start + i]
+
+    def set_length(self, i, length):
+        self.lengths[self.start + i] = length
+
+    def set_effect(self, i, effect):
+        self.effects[self.start + i] = NO_VALUE if effect == None else effect
+
+    def append(self, pitch, volume, waveform=None, effect=None, length=0,
+               count=1):
+        if self.stop != None:
+            raise ValueError('cannot append to a NoteBuffer view')
+
+        self.pitches.extend(
+            array('b', [NO_PITCH if pitch == None else pitch]) * count)
+        self.volumes.extend(array('b', [volume]) * count)
+        self.waveforms.extend(
+            array('b', [NO_VALUE if waveform == None else waveform]) * count)
+        self.effects.extend(
+            array('b', [NO_VALUE if effect == None else effect]) * count)
+        if self.lengths != None:
+            self.lengths.extend(array('l', [length]) * count)
+
+    # Append a copy of note i of another NoteBuffer
+    def append_from(self, other, i):
+        self.extend_from(other, i, i + 1)
+
+    # Append a copy of notes start to stop (not including stop) of another
+    # NoteBuffer. Notes from a buffer without a length column have a length
+    # of 1.
+    def extend_from(self, other, start, stop):
+        for column, otherColumn in zip(self.columns[:4], other.columns[:4]):
+            column.extend(otherColumn[other.start + start:other.start + stop])
+        if self.lengths != None:
+            if other.lengths != None:
+                self.lengths.extend(
+                        other.lengths[other.start + start:other.start + stop])
+            else:
+                self.lengths.extend(array('l', [1]) * (stop - start))
+
+    # Return the index of the first note with a volume above 0, or None
+    def find_first_audible_index(self):
+        for i in range(len(self)):
+            if self.volumes[self.start + i] > 0:
+                return i
+
+    # Return the index of the last note with a volume above 0, or None
+    def find_last_audible_index(self):
+        for i in range(len(self) - 1, -1, -1):
+            if self.volumes[self.start + i] > 0:
+                return i
+
+    # Return a Counter of the pitches of all the notes with a volume above 0
+    def count_audible_pitches(self):
+        stop = self.start + len(self)
+        return Counter(
+            pitch for pitch, volume in zip(self.pitches[self.start:stop],
+                                           self.volumes[self.start:stop])
+            if volume > 0 and pitch != NO_PITCH)
+
+    # Shift every note that has a pitch by the given number of semitones
+    def transpose(self, semitones):
+        stop = self.start + len(self)
+        self.pitches[self.start:stop] = array('b', [
+            pitch if pitch == NO_PITCH else pitch + semitones
+            for pitch in self.pitches[self.start:stop]])
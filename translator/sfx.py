@@ -2,3 +2,7 @@ class Sfx:
     def __init__(self, notes):
         self.notes = notes
         self.noteDuration = None
+
+        # The number of notes PICO-8 should play, when the SFX has to end
+        # before its last note to stay in time with the other channels
+        self.playLength = None
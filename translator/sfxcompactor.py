@@ -1,6 +1,15 @@
-from .note import Note
-from .sfx import Sfx
+import copy
+import functools
+import math
+from collections import Counter
 
+from pico8 import util
+
+from .notebuffer import NO_VALUE
+from .notebuffer import NoteBuffer
+
+from . import PICO8_MAX_NOTE_DURATION
+from . import PICO8_NOTES_PER_SFX
 from . import PICO8_NUM_SFX
 
 # SfxCompactor does the following:
@@ -8,149 +17,422 @@ from . import PICO8_NUM_SFX
 # that can be combined into one with each note-run's (where a "note-run" is the
 # same note repeated several times) length reduced (i.e.  divided by N) and the
 # note duration increased (i.e. multiplied by N) to compensate
+#
+# Rather than trying every N, the Ns that work at each position are worked out
+# directly (see find_compaction_factors).
+#
+# The note runs of each SFX are found once, up front, and only found again for
+# an SFX that is made by combining others. Every run of a group of SFXes can
+# be divided by N if N divides the greatest common divisor of all their
+# lengths, so each SFX is summed up by that one number (see find_runs_divisor)
+# and each position in the tracks by the GCD of the SFXes there.
+#
+# By default, the groups to combine in each pass over the tracks are planned
+# with dynamic programming (see find_optimal_plan), to use as few SFX slots as
+# possible in that pass; the "greedy" mode instead combines the largest
+# possible group at each position from left to right. A group combined in one
+# pass can stand in the way of a better one in a later pass, so planning each
+# pass doesn't always beat the greedy mode over all the passes; by default, the
+# tracks are compacted both ways and whichever uses fewer SFX slots is kept
+# (the greedy way on a tie).
+#
+# In the "independent" mode, each track in a group may be compacted by its own
+# factor M (at least N), for example a sparse bass line by more than a busy
+# melody. Its combined SFX then has N/M as many notes as the group, each M
+# times as long, so it takes as long to play as the other tracks' SFXes; it is
+# given a playLength so that PICO-8 stops it there.
 class SfxCompactor:
-    # "tracks" is a list of SFX lists
-    def __init__(self, tracks):
+    # "tracks" is a list of SFX lists. In the optimal mode, the plan fits as
+    # much of the song as it can into sfxLimit SFX slots.
+    def __init__(self, tracks, greedy=False, sfxLimit=PICO8_NUM_SFX,
+                 independent=False):
         self.tracks = tracks
-
-    def get_longest_track_sfx_count(self):
-        longestTrackSfxCount = 0
-        for track in self.tracks:
-            length = len(track)
-            if length > longestTrackSfxCount:
-                longestTrackSfxCount = length
-
-        # TODO don't check past what will fit in PICO-8; this needs to take start_offset into account
-        return longestTrackSfxCount
+        self.greedy = greedy
+        self.sfxLimit = sfxLimit
+        self.independent = independent
+
+        # The note runs of each SFX in each track, the GCD of their lengths,
+        # and whether the SFX has any audible notes
+        self.trackRuns = []
+        self.trackDivisors = []
+        self.trackAudibility = []
+        for track in tracks:
+            runLists = [SfxCompactor.find_note_runs(sfx.notes)
+                        for sfx in track]
+            self.trackRuns.append(runLists)
+            self.trackDivisors.append(
+                [SfxCompactor.find_runs_divisor(runs) for runs in runLists])
+            self.trackAudibility.append(
+                [sfx.notes.find_first_audible_index() != None
+                 for sfx in track])
 
     def run(self):
-        while True:
-            anyCompressionOccurred = False
-
-            # TODO: figure out optimal highest N to try first
-            n = 32
-            while n > 1:
-                anyCompressionOccurred = self.optimize_sfx_speeds(n)
-                n -= 1
-
-            if not anyCompressionOccurred:
+        compactor = self
+        if self.greedy:
+            self.compact()
+        else:
+            # Compact a copy of the tracks greedily too (the Sfx objects are
+            # copied, but not their NoteBuffers, which are never changed), and
+            # keep whichever way is cheaper, or the greedy way on a tie, so the
+            # planned one only changes a cart when it saves something
+            greedyCompactor = SfxCompactor(
+                    [[copy.copy(sfx) for sfx in track] for track in self.tracks],
+                    greedy=True, sfxLimit=self.sfxLimit,
+                    independent=self.independent)
+            greedyCompactor.compact()
+            self.compact()
+            if greedyCompactor.find_cost() <= self.find_cost():
+                util.debug('greedy compaction is no worse than the planned ' +
+                           'one\n')
+                compactor = greedyCompactor
+
+        for n, savedSfxCount in sorted(compactor.savedSfxCounts.items(),
+                                       reverse=True):
+            util.write('saved {0} SFX slots (note group length: {1})\n'.format(
+                savedSfxCount, n))
+
+        return compactor.tracks
+
+    def compact(self):
+        self.savedSfxCounts = Counter()
+
+        # Combining SFXes can make new groups combinable, so keep going until
+        # nothing changes
+        while self.optimize_sfx_speeds(self.savedSfxCounts):
+            pass
+
+    # Find the cost of the tracks as compacted: the number of SFX slots they
+    # use (only SFXes with audible notes use one), then the number of SFXes
+    def find_cost(self):
+        return (sum(sum(audibility) for audibility in self.trackAudibility),
+                sum(len(track) for track in self.tracks))
+
+    # Find the GCD of the lengths of the SFXes at the given position in all the
+    # tracks that are that long
+    def find_position_divisor(self, sfxIndex):
+        divisor = 0
+        for divisors in self.trackDivisors:
+            if sfxIndex < len(divisors):
+                divisor = math.gcd(divisor, divisors[sfxIndex])
+        return divisor
+
+    # Find a bitmask of the tracks whose SFX at the given position has any
+    # audible notes (only those use up an SFX slot in the cartridge)
+    def find_position_audibility(self, sfxIndex):
+        mask = 0
+        for t, audibility in enumerate(self.trackAudibility):
+            if sfxIndex < len(audibility) and audibility[sfxIndex]:
+                mask |= 1 << t
+        return mask
+
+    # Find a bitmask of the tracks that have an SFX at the given position
+    def find_position_presence(self, sfxIndex):
+        mask = 0
+        for t, track in enumerate(self.tracks):
+            if sfxIndex < len(track):
+                mask |= 1 << t
+        return mask
+
+    # Find every N (including 1) for which the N SFXes starting at
+    # sfxIndexStart can be combined, given the divisor of each position, in
+    # increasing order. In every track, the SFXes must have the same note
+    # duration, which must still fit in PICO8_MAX_NOTE_DURATION once it is
+    # multiplied by N. Near the end of the song, N may be larger than the
+    # number of SFXes left (as long as there are at least two), as the runs
+    # of the SFXes that are left only need to divide evenly by N.
+    def find_compaction_factors(self, sfxIndexStart, positionDivisors):
+        if len(positionDivisors) - sfxIndexStart < 2:
+            return [1]
+
+        maxN = PICO8_NOTES_PER_SFX
+        for track in self.tracks:
+            if sfxIndexStart >= len(track):
+                continue
+            noteDuration = track[sfxIndexStart].noteDuration
+            maxN = min(maxN, PICO8_MAX_NOTE_DURATION // noteDuration)
+
+            sfxIndexEnd = min(sfxIndexStart + maxN, len(track))
+            for s in range(sfxIndexStart + 1, sfxIndexEnd):
+                if track[s].noteDuration != noteDuration:
+                    maxN = s - sfxIndexStart
+                    break
+
+        if self.independent:
+            return self.find_independent_compaction_factors(sfxIndexStart,
+                                                            maxN)
+
+        # The runs of the first N SFXes all divide evenly by N if N divides
+        # the GCD of the divisors of the first N positions (or of as many
+        # positions as there are)
+        factors = [1]
+        divisor = 0
+        for n in range(1, maxN + 1):
+            s = sfxIndexStart + n - 1
+            if s < len(positionDivisors):
+                divisor = math.gcd(divisor, positionDivisors[s])
+            if divisor == 1:
                 break
+            if n > 1 and divisor % n == 0:
+                factors.append(n)
+
+        return factors
+
+    # In the independent mode, find every N (up to maxN) for which the N SFXes
+    # starting at sfxIndexStart can be combined, in increasing order. Each
+    # track only needs its own factor, from find_track_factor.
+    def find_independent_compaction_factors(self, sfxIndexStart, maxN):
+        factors = [1]
+        trackDivisors = [0] * len(self.tracks)
+        for n in range(1, maxN + 1):
+            allTracksFit = True
+            for t, divisors in enumerate(self.trackDivisors):
+                s = sfxIndexStart + n - 1
+                if s < len(divisors):
+                    trackDivisors[t] = math.gcd(trackDivisors[t], divisors[s])
+                if (sfxIndexStart < len(divisors) and
+                        self.find_track_factor(t, sfxIndexStart, n,
+                                               trackDivisors[t]) == None):
+                    allTracksFit = False
+
+            # A track that can't be combined at N can't be at any larger N
+            # either, as its GCD only gets smaller
+            if not allTracksFit:
+                break
+            if n > 1:
+                factors.append(n)
+
+        return factors
+
+    # Find the smallest factor M, at least N, that divides every run of the
+    # group of N SFXes starting at sfxIndexStart in a track (given the GCD of
+    # their lengths), and that keeps the note duration within
+    # PICO8_MAX_NOTE_DURATION; or None if there isn't one
+    def find_track_factor(self, trackIndex, sfxIndexStart, n, divisor=None):
+        if divisor == None:
+            divisors = self.trackDivisors[trackIndex]
+            divisor = functools.reduce(
+                    math.gcd, divisors[sfxIndexStart:sfxIndexStart + n], 0)
+        if divisor == 0:
+            return n
+
+        noteDuration = self.tracks[trackIndex][sfxIndexStart].noteDuration
+        for m in range(n, min(divisor, PICO8_MAX_NOTE_DURATION // noteDuration)
+                          + 1):
+            if divisor % m == 0:
+                return m
+
+    # Plan a pass greedily: combine the largest possible group at each
+    # position, from left to right. Return a list of (sfxIndexStart, N).
+    def find_greedy_plan(self, positionDivisors):
+        plan = []
+        sfxIndexStart = 0
+        while sfxIndexStart < len(positionDivisors):
+            n = self.find_compaction_factors(sfxIndexStart,
+                                             positionDivisors)[-1]
+            plan.append((sfxIndexStart, n))
+            sfxIndexStart += n
+        return plan
+
+    # Find the fewest SFX slots (and then SFXes) needed for the positions from
+    # start up to each later position (where costs[i] is the (slots, SFXes)
+    # cost of the positions before i) and the last group, (sfxIndexStart, N),
+    # of the cheapest way to get there
+    def find_plan_costs(self, start, positionDivisors, positionAudibility,
+                        positionPresence):
+        positionCount = len(positionDivisors)
+        costs = [None] * (positionCount + 1)
+        lastGroups = [None] * (positionCount + 1)
+        costs[start] = (0, 0)
+
+        for i in range(start, positionCount):
+            factors = self.find_compaction_factors(i, positionDivisors)
+            mask = 0
+            presenceMask = 0
+            n = 0
+            for factor in factors:
+                # Add up which tracks are audible, and which have any SFXes,
+                # in the group
+                while n < factor and i + n < positionCount:
+                    mask |= positionAudibility[i + n]
+                    presenceMask |= positionPresence[i + n]
+                    n += 1
+                cost = (costs[i][0] + bin(mask).count('1'),
+                        costs[i][1] + bin(presenceMask).count('1'))
+
+                # On a tie, keep the smaller N (which was found first)
+                j = min(i + factor, positionCount)
+                if costs[j] == None or cost < costs[j]:
+                    costs[j] = cost
+                    lastGroups[j] = (i, factor)
+
+        return costs, lastGroups
+
+    # Plan a pass with dynamic programming. First fit as many positions as
+    # possible into sfxLimit SFX slots using as few slots as possible, then
+    # use as few slots as possible for the rest of the song (which won't fit
+    # in the cartridge, but can still be shown with --midi-offset). Return a
+    # list of (sfxIndexStart, N).
+    def find_optimal_plan(self, positionDivisors):
+        positionCount = len(positionDivisors)
+        positionAudibility = [self.find_position_audibility(s)
+                              for s in range(positionCount)]
+        positionPresence = [self.find_position_presence(s)
+                            for s in range(positionCount)]
+
+        plan = []
+        start = 0
+        sfxLimit = self.sfxLimit
+        while start < positionCount:
+            costs, lastGroups = self.find_plan_costs(start, positionDivisors,
+                                                     positionAudibility,
+                                                     positionPresence)
+            end = positionCount
+            if sfxLimit != None:
+                for j in range(positionCount, start, -1):
+                    if costs[j] != None and costs[j][0] <= sfxLimit:
+                        end = j
+                        break
+                sfxLimit = None
+
+            # Follow the groups back from the end
+            groups = []
+            j = end
+            while j > start:
+                groups.append(lastGroups[j])
+                j = lastGroups[j][0]
+            plan.extend(reversed(groups))
+            start = end
+
+        return plan
+
+    # Make one pass over all the positions in the tracks, combining groups of
+    # SFXes; return whether any were combined
+    def optimize_sfx_speeds(self, savedSfxCounts):
+        anyCompressionOccurred = False
 
-        return self.tracks
-
-    def get_track_section(self, trackIndex, sfxIndexStart, n):
-        trackSection = TrackSection(trackIndex)
-        track = self.tracks[trackIndex]
-        trackSection.sfxList = track[sfxIndexStart:sfxIndexStart + n]
-
-        for s, sfx in enumerate(trackSection.sfxList):
-            noteRuns = self.find_note_runs(sfx.notes)
-            trackSection.sfxNoteRunLists.append(noteRuns)
-
-        if len(trackSection.sfxList) > 0:
-            return trackSection
-
-    def get_track_sections(self, sfxIndexStart, n):
-        trackSections = []
-        for t, track in enumerate(self.tracks):
-            trackSection = self.get_track_section(t, sfxIndexStart, n)
-            if trackSection != None:
-                trackSections.append(trackSection)
+        # The divisor of each position, up to the end of the longest track
+        longestTrackSfxCount = max([len(track) for track in self.tracks] + [0])
+        positionDivisors = [self.find_position_divisor(s)
+                            for s in range(longestTrackSfxCount)]
 
-        return trackSections
+        if self.greedy:
+            plan = self.find_greedy_plan(positionDivisors)
+        else:
+            plan = self.find_optimal_plan(positionDivisors)
 
-    def optimize_sfx_speeds(self, n):
-        anyCompressionOccurred = False
-        savedSfxCount = 0
-        sfxIndexStart = 0
-        while sfxIndexStart < self.get_longest_track_sfx_count():
-            trackSections = self.get_track_sections(sfxIndexStart, n)
-
-            # Check if all note runs have lengths divisible by N
-            allRunsDivideEvenly = True
-            for trackSection in trackSections:
-                for runList in trackSection.sfxNoteRunLists:
-                    for run in runList:
-                        if len(run) % n != 0:
-                            allRunsDivideEvenly = False
-
-            if allRunsDivideEvenly:
+        # Combine the groups from the last one back, so that combining a group
+        # doesn't move the ones that are still to be combined
+        for sfxIndexStart, n in reversed(plan):
+            if n > 1:
                 anyCompressionOccurred = True
-                savedSfxCount += (n - 1)
-
-                for t, trackSection in enumerate(trackSections):
-                    # Remove notes from each run and collect all the notes into
-                    # a contiguous list
-                    allNotes = []
-                    for runList in trackSection.sfxNoteRunLists:
-                        for r, run in enumerate(runList):
-                            newLength = int(len(run) / n)
-                            allNotes.extend(run[-newLength:])
-
-                    # Replace the first SFX's notes with the concatenation of
-                    # all the now-shortened notes in the group of SFX
-                    trackSection.sfxList[0].notes = allNotes
-                    trackSection.sfxList[0].noteDuration *= n
-
-                    # Delete the now-empty SFXes in this track
-                    del self.tracks[trackSection.trackIndex][
-                            sfxIndexStart + 1 : sfxIndexStart + n]
-            sfxIndexStart += 1
-
-        if savedSfxCount > 0:
-            print('saved {0} SFX slots (note group length: {1})'.format(savedSfxCount, n))
+                # The last group of the song may have fewer than N SFXes
+                savedSfxCounts[n] += min(n, longestTrackSfxCount -
+                                            sfxIndexStart) - 1
+
+                for t, track in enumerate(self.tracks):
+                    if sfxIndexStart < len(track):
+                        if self.independent:
+                            factor = self.find_track_factor(t, sfxIndexStart,
+                                                            n)
+                        else:
+                            factor = n
+                        self.combine_sfxes(t, sfxIndexStart, n, factor)
 
         return anyCompressionOccurred
 
-    # Find all the note runs (where a "run" is a list of consecutive PICO-8
-    # notes that are all representing the same MIDI note) in a given list of
-    # notes
-    def find_note_runs(self, notes):
+    # Replace the N SFXes (or as many as the track has left) starting at
+    # sfxIndexStart in a track with one SFX containing the last 1/M of each of
+    # their note runs, played M times slower (where M is the factor, which is
+    # N unless the tracks are compacted independently)
+    def combine_sfxes(self, trackIndex, sfxIndexStart, n, factor):
+        track = self.tracks[trackIndex]
+        runLists = self.trackRuns[trackIndex]
+        divisors = self.trackDivisors[trackIndex]
+        audibility = self.trackAudibility[trackIndex]
+        sfxIndexEnd = sfxIndexStart + n
+
+        # Remove notes from each run and collect all the notes into a
+        # contiguous NoteBuffer
+        allNotes = NoteBuffer(lengths=False)
+        for sfx, runs in zip(track[sfxIndexStart:sfxIndexEnd],
+                             runLists[sfxIndexStart:sfxIndexEnd]):
+            for run in runs:
+                newLength = len(run) // factor
+                allNotes.extend_from(sfx.notes, run.stop - newLength, run.stop)
+
+        # Replace the first SFX's notes with the concatenation of all the
+        # now-shortened notes in the group of SFX
+        sfx = track[sfxIndexStart]
+        shortened = any(other.playLength != None
+                        for other in track[sfxIndexStart:sfxIndexEnd])
+        sfx.notes = allNotes
+        sfx.noteDuration *= factor
+        if (factor > n or shortened) and len(allNotes) < PICO8_NOTES_PER_SFX:
+            # Stop the SFX after its notes, in time with the other channels
+            sfx.playLength = len(allNotes)
+        else:
+            sfx.playLength = None
+        runLists[sfxIndexStart] = SfxCompactor.find_note_runs(allNotes)
+        divisors[sfxIndexStart] = SfxCompactor.find_runs_divisor(
+                runLists[sfxIndexStart])
+        audibility[sfxIndexStart] = any(audibility[sfxIndexStart:sfxIndexEnd])
+
+        # Delete the now-empty SFXes in this track
+        del track[sfxIndexStart + 1:sfxIndexEnd]
+        del runLists[sfxIndexStart + 1:sfxIndexEnd]
+        del divisors[sfxIndexStart + 1:sfxIndexEnd]
+        del audibility[sfxIndexStart + 1:sfxIndexEnd]
+
+    # Find the greatest common divisor of the lengths of a list of note runs
+    # (0 if there are no runs, since every N divides 0)
+    @staticmethod
+    def find_runs_divisor(runs):
+        return functools.reduce(math.gcd, [len(run) for run in runs], 0)
+
+    # Find all the note runs (where a "run" is a range of the indexes of
+    # consecutive PICO-8 notes that are all representing the same MIDI note)
+    # in a given NoteBuffer.
+    #
+    # A note with an effect ends its run, and also starts the next one (so it
+    # is counted in both), and a last note that doesn't belong to the run
+    # before it is not in any run.
+    @staticmethod
+    def find_note_runs(notes):
         runs = []
 
-        run = []
-        for n, note in enumerate(notes):
-            currentRunShouldEnd = False
-
-            noteBelongsToCurrentRun = False
-            if len(run) > 0:
-                prevNote = run[-1]
-            else:
-                prevNote = None
-
-            if prevNote != None:
-                if (note.pitch == prevNote.pitch and
-                    note.volume == prevNote.volume and
-                    note.waveform == prevNote.waveform):
+        # Compare the raw column values (None is stored as a sentinel value,
+        # which compares equal to itself just like None does)
+        start = notes.start
+        pitches = notes.pitches
+        volumes = notes.volumes
+        waveforms = notes.waveforms
+        effects = notes.effects
+        noteCount = len(notes)
+
+        runStart = 0
+        for n in range(noteCount):
+            i = start + n
+
+            noteBelongsToCurrentRun = True
+            if n > 0:
+                p = i - 1
+                if (pitches[i] == pitches[p] and
+                    volumes[i] == volumes[p] and
+                    waveforms[i] == waveforms[p]):
                     noteBelongsToCurrentRun = True
-                elif note.volume == 0 and prevNote.volume == 0:
+                elif volumes[i] == 0 and volumes[p] == 0:
                     noteBelongsToCurrentRun = True
+                else:
+                    noteBelongsToCurrentRun = False
 
-            # If this note should be added to the current run
-            if noteBelongsToCurrentRun or len(run) == 0:
-                run.append(note)
-
+            if noteBelongsToCurrentRun:
                 # If this note has an effect, it must be the last in the run
-                if note.effect != None:
-                    currentRunShouldEnd = True
+                if effects[i] != NO_VALUE or n == noteCount - 1:
+                    runs.append(range(runStart, n + 1))
+                    runStart = n
             else:
-                currentRunShouldEnd = True
-
-            if n == len(notes) - 1:
-                currentRunShouldEnd = True
-
-            if currentRunShouldEnd:
-                # End the current run
-                runs.append(run)
-
-                # Add the current note to a new run
-                run = [note]
+                # End the current run, and start a new one with this note
+                runs.append(range(runStart, n))
+                runStart = n
 
         return runs
-
-
-class TrackSection:
-    def __init__(self, trackIndex):
-        self.trackIndex = trackIndex
-        self.sfxList = []
-        self.sfxNoteRunLists = []
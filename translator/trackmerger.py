@@ -0,0 +1,110 @@
+from pico8 import util
+
+from .notebuffer import NoteBuffer
+
+# TrackMerger does the following:
+# Find the spans of time during which each track (a run-length NoteBuffer) is
+# audible, and pack tracks that are never audible at the same time together
+# into one track, so that they use one PICO-8 channel (and one set of SFXes)
+# instead of several
+class TrackMerger:
+    # "tracks" is a list of run-length NoteBuffers
+    def __init__(self, tracks, legato=False):
+        self.tracks = tracks
+        self.legato = legato
+
+    # Return a sorted list of (start, end) spans (in PICO-8 notes) during
+    # which a track is audible, with touching spans joined together
+    @staticmethod
+    def find_audible_spans(runs):
+        spans = []
+        time = 0
+        for r in range(len(runs)):
+            length = runs.length(r)
+            if runs.volume(r) > 0:
+                if len(spans) > 0 and spans[-1][1] == time:
+                    spans[-1] = (spans[-1][0], time + length)
+                else:
+                    spans.append((time, time + length))
+            time += length
+        return spans
+
+    # Check if two sorted lists of spans overlap anywhere
+    @staticmethod
+    def spans_overlap(spans1, spans2):
+        i = 0
+        j = 0
+        while i < len(spans1) and j < len(spans2):
+            start1, end1 = spans1[i]
+            start2, end2 = spans2[j]
+            if start1 < end2 and start2 < end1:
+                return True
+            if end1 <= end2:
+                i += 1
+            else:
+                j += 1
+        return False
+
+    # Combine two sorted lists of spans that don't overlap
+    @staticmethod
+    def merge_spans(spans1, spans2):
+        return sorted(spans1 + spans2)
+
+    # Make one run-length NoteBuffer out of the audible runs of several
+    # tracks that are never audible at the same time, with rests in between.
+    # Unless legato is on, a run that ends right where a run of the same pitch
+    # from another track starts is given a fadeout effect, as
+    # Translator.get_pico_notes does for the notes of one track, so the two
+    # are not heard as one long note.
+    @staticmethod
+    def interleave_tracks(tracks, legato=False):
+        audibleRuns = []
+        for runs in tracks:
+            time = 0
+            for r in range(len(runs)):
+                if runs.volume(r) > 0:
+                    audibleRuns.append((time, r, runs))
+                time += runs.length(r)
+        audibleRuns.sort(key=lambda audibleRun: audibleRun[0])
+
+        merged = NoteBuffer()
+        time = 0
+        for start, r, runs in audibleRuns:
+            if start > time:
+                merged.append(None, 0, length=start - time)
+            elif (not legato and len(merged) > 0 and
+                  merged.pitch(len(merged) - 1) == runs.pitch(r)):
+                merged.set_effect(len(merged) - 1, 5)
+            merged.append_from(runs, r)
+            time = start + runs.length(r)
+
+        return merged
+
+    def run(self):
+        # Put each track into the first group of tracks that it doesn't
+        # overlap with, or into a new group if there is none
+        groups = []
+        groupSpans = []
+        for t, track in enumerate(self.tracks):
+            spans = TrackMerger.find_audible_spans(track)
+            for g in range(len(groups)):
+                if not TrackMerger.spans_overlap(groupSpans[g], spans):
+                    groups[g].append(t)
+                    groupSpans[g] = TrackMerger.merge_spans(groupSpans[g],
+                                                            spans)
+                    break
+            else:
+                groups.append([t])
+                groupSpans.append(spans)
+
+        mergedTracks = []
+        for group in groups:
+            if len(group) == 1:
+                mergedTracks.append(self.tracks[group[0]])
+            else:
+                util.write('merged tracks {0} into one track\n'.format(
+                    ', '.join(str(t) for t in group)))
+                mergedTracks.append(TrackMerger.interleave_tracks(
+                    [self.tracks[t] for t in group], self.legato))
+
+        return mergedTracks
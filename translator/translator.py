@@ -1,11 +1,17 @@
-import copy
-import math
+import bisect
+import heapq
 import statistics
+from collections import Counter
+
+from pico8 import util
 
 from .note import Note
+from .notebuffer import NoteBuffer
 from .sfx import Sfx
 from .sfxcompactor import SfxCompactor
+from .trackmerger import TrackMerger
 
+from . import MIDI_DEFAULT_BPM
 from . import PICO8_MIN_NOTE_DURATION
 from . import PICO8_MAX_PITCH
 from . import PICO8_NOTES_PER_SFX
@@ -20,10 +26,26 @@ class TranslatorSettings:
         self.staccato = False
         self.legato = False
         self.fixOctaves = True
+        self.bestFitOctaves = False
+        self.polyphony = False
+        self.mergeTracks = False
+        # The indexes of the MIDI tracks to translate, or None for all of
+        # them; the other tracks are never decoded
+        self.midiTracks = None
         self.noteDurationOverride = None
         self.sfxCompactor = True
+        self.greedyCompaction = False
+        self.independentCompaction = False
 
 class Translator:
+    # The only MIDI event types the translator looks at; MIDI files can be
+    # read with MidiFile.read(keep=Translator.MIDI_EVENT_TYPES). The order in
+    # which channels first appear in a track (see find_occupied_channels())
+    # decides the order of the PICO-8 tracks, and it takes every channel
+    # message into account, but MidiTrack records it while reading, even for
+    # the events that are skipped.
+    MIDI_EVENT_TYPES = ('NOTE_OFF', 'NOTE_ON', 'SET_TEMPO')
+
     def __init__(self, midiFile, settings: TranslatorSettings=None): 
         self.midiFile = midiFile
 
@@ -33,149 +55,304 @@ class Translator:
             self.settings = TranslatorSettings()
 
         if self.settings.ticksPerNoteOverride != None:
-            print('setting ticks per note to override setting of ' +
-                  str(self.settings.ticksPerNoteOverride))
+            util.write('setting ticks per note to override setting of ' +
+                       str(self.settings.ticksPerNoteOverride) + '\n')
         self.baseTicks = self.settings.ticksPerNoteOverride
 
+        # How far note lengths are from multiples of baseTicks (see
+        # find_quantization_error()), set by analyze()
+        self.quantizationError = None
+
+        # The number of note lengths changed by quantization and the total
+        # number of MIDI ticks they were moved by, counted by
+        # convert_ticks_to_notelength() during each get_sfx_lists() call
+        self.quantizedNoteCount = 0
+        self.quantizationDrift = 0
+
+        # List of (track, channel, notes) for every channel used in every
+        # translated MIDI track, built by get_channel_notes(), keyed by the
+        # polyphony and MIDI track settings it was built with
+        self.channelNotes = {}
+
+        # Milliseconds per MIDI tick, found from the MIDI file's tempo by
+        # find_midi_ms_per_tick()
+        self.midiMsPerTick = None
+
+    # Turn the NOTE_ON and NOTE_OFF events of this channel into a monophonic
+    # list of notes and rests: each note lasts until the next event on the
+    # channel (the next note starting, or any note being released), so of
+    # the notes in a chord, the one that comes last in the file is kept
     def find_notes(self, track, channel):
+        # Skip all drums for now
+        if channel == None or channel == 10:
+            return []
+
         notes = []
         activeNote = None
-        deltaTime = 0
-        firstNoteHasBeenAdded = False
-
-        events = [
-                event for event in track.events
-                if event.channel == channel or event.type == 'DeltaTime']
-
-        for e, event in enumerate(events):
-            if event.type == 'DeltaTime':
-                deltaTime += event.time
-            if event.type == 'NOTE_ON' or event.type == 'NOTE_OFF':
-                # Skip all drums for now
-                if event.channel == 10:
-                    continue
+        lastTime = 0
+        for time, pitch, velocity in track.channels[channel - 1].noteEvents:
+            deltaTime = time - lastTime
+            if activeNote != None:
+                activeNote.midiDuration = deltaTime
+                activeNote = None
+            elif deltaTime > 0:
+                rest = Note()
+                rest.midiDuration = deltaTime
+                notes.append(rest)
+
+            if velocity > 0:
+                activeNote = Note()
+                activeNote.set_midi_note(pitch, channel, velocity)
+                notes.append(activeNote)
+
+            lastTime = time
 
-                if activeNote != None:
-                    activeNote.midiDuration = deltaTime
-                    activeNote = None
-                elif deltaTime > 0:
-                    note = Note()
-                    note.midiDuration = deltaTime
-                    notes.append(note)
+        return notes
+
+    # Split the note table of this channel into the fewest monophonic voices
+    # (so that chords and other overlapping notes are kept instead of being
+    # cut off), and return a list of notes and rests for each voice
+    def find_voices(self, track, channel):
+        # Skip all drums for now
+        if channel == None or channel == 10:
+            return []
 
-                if event.type == 'NOTE_ON' and event.velocity > 0:
-                    note = Note(event)
-                    activeNote = note
-                    notes.append(note)
+        table = track.channels[channel - 1].noteTable()
+        return [Translator.make_note_list(voice, channel)
+                for voice in Translator.allocate_voices(table)]
 
-                deltaTime = 0
+    # Make a list of notes and rests from a sorted note table of (start, end,
+    # pitch, velocity) tuples
+    @staticmethod
+    def make_note_list(table, channel):
+        notes = []
+        lastTime = 0
+        for i, (start, end, pitch, velocity) in enumerate(table):
+            if start > lastTime:
+                rest = Note()
+                rest.midiDuration = start - lastTime
+                notes.append(rest)
+
+            if i < len(table) - 1 and table[i + 1][0] < end:
+                end = table[i + 1][0]
+
+            note = Note()
+            note.set_midi_note(pitch, channel, velocity)
+            note.midiDuration = end - start
+            notes.append(note)
+            lastTime = end
 
         return notes
 
+    # Sweep through a note table in order of start time, giving each note to
+    # a voice that is free by then, or to a new voice if none is. This uses as
+    # few voices as the most notes that overlap at any time. Notes that start
+    # together (e.g. a chord) are matched up with free voices in order of
+    # pitch, picking the free voices whose last pitches are closest, so that
+    # voices don't cross and each one moves as smoothly as possible. Return a
+    # sorted note table for each voice.
+    @staticmethod
+    def allocate_voices(table):
+        voices = []
+
+        # (end time, voice index) of each voice that is playing a note
+        busyVoices = []
+
+        # (last pitch, voice index) of each free voice, sorted by pitch
+        freeVoices = []
+
+        table = sorted(table)
+        i = 0
+        while i < len(table):
+            start = table[i][0]
+
+            # Collect the notes that start at this time, sorted by pitch
+            j = i + 1
+            while j < len(table) and table[j][0] == start:
+                j += 1
+            group = sorted(table[i:j], key=lambda note: note[2])
+            i = j
+
+            # Free every voice whose note has ended by the time these start
+            while len(busyVoices) > 0 and busyVoices[0][0] <= start:
+                endTime, v = heapq.heappop(busyVoices)
+                bisect.insort(freeVoices, (voices[v][-1][2], v))
+
+            # Pair a run of the notes with a run of the free voices (the
+            # shorter of the two lists slides along the longer one), choosing
+            # the pairing with the smallest total pitch difference
+            pairCount = min(len(group), len(freeVoices))
+            bestCost = None
+            bestNoteOffset = 0
+            bestVoiceOffset = 0
+            if len(group) == 1 and pairCount == 1:
+                # A single note: find the free voice with the closest pitch
+                # with a binary search
+                pitch = group[0][2]
+                k = bisect.bisect_left(freeVoices, (pitch, -1))
+                if k == len(freeVoices) or (
+                        k > 0 and pitch - freeVoices[k - 1][0] <=
+                                  freeVoices[k][0] - pitch):
+                    k -= 1
+                bestVoiceOffset = k
+                offsets = ()
+            else:
+                offsets = range(abs(len(group) - len(freeVoices)) + 1)
+            for offset in offsets:
+                if len(group) > len(freeVoices):
+                    noteOffset, voiceOffset = offset, 0
+                else:
+                    noteOffset, voiceOffset = 0, offset
+                cost = 0
+                for k in range(pairCount):
+                    cost += abs(group[noteOffset + k][2] -
+                                freeVoices[voiceOffset + k][0])
+                if bestCost == None or cost < bestCost:
+                    bestCost = cost
+                    bestNoteOffset = noteOffset
+                    bestVoiceOffset = voiceOffset
+
+            pairedVoices = freeVoices[bestVoiceOffset:
+                                      bestVoiceOffset + pairCount]
+            del freeVoices[bestVoiceOffset:bestVoiceOffset + pairCount]
+
+            for n, note in enumerate(group):
+                k = n - bestNoteOffset
+                if 0 <= k < pairCount:
+                    v = pairedVoices[k][1]
+                else:
+                    # There are no free voices left for this note
+                    v = len(voices)
+                    voices.append([])
+
+                voices[v].append(note)
+                heapq.heappush(busyVoices, (note[1], v))
+
+        return voices
+
+    # Split every MIDI track into its channels and find each channel's notes,
+    # in one pass over the events of each track. The result is kept, so
+    # analyze(), get_sfx_lists() and anything else that needs the notes of
+    # each (track, channel) can share it. It is kept per polyphony and MIDI
+    # track settings, the only settings the notes depend on, so changing
+    # self.settings between calls doesn't return notes built for the old
+    # settings.
+    def get_channel_notes(self):
+        polyphony = self.settings.polyphony
+        midiTracks = self.settings.midiTracks
+        if midiTracks != None:
+            midiTracks = tuple(midiTracks)
+        key = (polyphony, midiTracks)
+        if key not in self.channelNotes:
+            channelNotes = []
+            for track in self.midiFile.tracks:
+                if midiTracks != None and not track.index in midiTracks:
+                    continue
+                for channel in self.find_occupied_channels(track):
+                    if polyphony:
+                        # Each voice of the channel becomes its own entry
+                        for notes in self.find_voices(track, channel):
+                            channelNotes.append((track, channel, notes))
+                    else:
+                        notes = self.find_notes(track, channel)
+                        channelNotes.append((track, channel, notes))
+            self.channelNotes[key] = channelNotes
+
+        return self.channelNotes[key]
+
     def analyze(self):
-        print('MIDI format is type ' + str(self.midiFile.format))
+        util.write('MIDI format is type ' + str(self.midiFile.format) + '\n')
 
-        # Get a list of unique note lengths and the number of occurrences of
-        # each length
-        uniqueLengths = {}
+        # Count the number of occurrences of each note length
+        lengthCounts = Counter()
         noteCount = 0
-        for track in self.midiFile.tracks:
-            occupiedChannels = self.find_occupied_channels(track)
-            for channel in occupiedChannels:
-                notes = self.find_notes(track, channel)
-                
-                for note in notes:
-                    noteCount += 1
-                    length = note.midiDuration
-                    if length > 0:
-                        if not length in uniqueLengths:
-                            uniqueLengths[length] = 0
-                        uniqueLengths[length] += 1
+        for track, channel, notes in self.get_channel_notes():
+            noteCount += len(notes)
+            lengthCounts.update(note.midiDuration for note in notes
+                                if note.midiDuration > 0)
 
-        # DEBUG
-        import operator
-        #print('unique lengths:')
-        #sortedUniqueLengths = sorted(
-        #    uniqueLengths.items(),
-        #    key=operator.itemgetter(1),
-        #    reverse=True)
-        #print(sortedUniqueLengths)
-
-        mostFrequentLength = None
-        highestCount = 0
-        for length, count in uniqueLengths.items():
-            if count > highestCount:
-
-                highestCount = count
-                mostFrequentLength = length
-
-        print('note count: ' + str(noteCount))
-        print('most frequent length: ' + str(mostFrequentLength))
-
-        # Find the average number of occurrences for a unique length
-        averageOccurences = statistics.mean(uniqueLengths.values())
-        print('mean occurrences: ' + str(averageOccurences))
-        print('median occurrences: ' +
-              str(statistics.median(uniqueLengths.values())))
-
-        # Remove lengths from uniqueLengths that have less than the average
-        # number of occurrences
-        newUniqueLengths = {}
-        for length, occurrences in uniqueLengths.items():
-            if occurrences >= averageOccurences:
-                newUniqueLengths[length] = occurrences
-        uniqueLengths = newUniqueLengths
-
-        # Take each length and divide the other lengths by it, counting how
-        # many other lengths it divides evenly into
-        candidateBaseLengths = {}
-        for length, occurrences in uniqueLengths.items():
-            for otherLength in uniqueLengths.keys():
-                if otherLength % length == 0:
-                    if not length in candidateBaseLengths:
-                        candidateBaseLengths[length] = 0
-                    candidateBaseLengths[length] += 1
-
-        # DEBUG
-        print('candidate base lengths:')
-        sortedCandidateBaseLengths = sorted(
-            candidateBaseLengths.items(),
-            key=operator.itemgetter(1),
-            reverse=True)
-        for length, score in sortedCandidateBaseLengths:
-            print(length, score)
-
-
-        # Find the best of the candidate base-lengths, where "best" is the one
-        # with the most even divisions into other lengths. If there is a tie,
-        # prefer the shortest candidate base-length.
-        bestBaseLength = None
-        highestNumberOfEvenDivisions = 0
-        for length, evenDivisionCount in candidateBaseLengths.items():
-            if evenDivisionCount > highestNumberOfEvenDivisions:
-                highestNumberOfEvenDivisions = evenDivisionCount
-                bestBaseLength = length
-            elif evenDivisionCount == highestNumberOfEvenDivisions:
-                if length < bestBaseLength:
-                    bestBaseLength = length
+        util.debug('note count: ' + str(noteCount) + '\n')
+        if len(lengthCounts) > 0:
+            util.debug('most frequent length: ' +
+                       str(lengthCounts.most_common(1)[0][0]) + '\n')
 
         if self.baseTicks == None:
-            print('setting MIDI base ticks per note to ' + str(bestBaseLength))
-            self.baseTicks = bestBaseLength
+            self.baseTicks = Translator.find_base_ticks(lengthCounts)
+            if self.baseTicks == None:
+                # There is nothing to translate; get_sfx_lists() will return
+                # no tracks
+                util.error('no notes in the selected tracks\n')
+                self.quantizationError = 0.0
+                self.noteDuration = None
+                return
+            util.write('setting MIDI base ticks per note to ' +
+                       str(self.baseTicks) + '\n')
+
+        self.quantizationError = Translator.find_quantization_error(
+                lengthCounts, self.baseTicks)
+        util.write('quantization error: {0:.3f}\n'.format(
+            self.quantizationError))
 
         self.noteDuration = self.find_note_duration()
-        print('PICO-8 note duration: ' + str(self.noteDuration))
+        util.write('PICO-8 note duration: ' + str(self.noteDuration) + '\n')
+
+    # Find the best base note length (in MIDI ticks) for a histogram of note
+    # lengths. The candidates are the lengths that occur at least as often as
+    # the average length does; each candidate scores the number of notes
+    # whose length it divides evenly into. If there is a tie, prefer the
+    # shortest candidate. Return None if there are no lengths at all.
+    @staticmethod
+    def find_base_ticks(lengthCounts):
+        if len(lengthCounts) == 0:
+            return None
+
+        averageCount = statistics.mean(lengthCounts.values())
+        candidates = set(length for length, count in lengthCounts.items()
+                         if count >= averageCount)
+
+        # Add each length's count to the score of every candidate that
+        # divides it, by enumerating the length's divisors (rather than
+        # trying every candidate against every length)
+        scores = Counter()
+        for length, count in lengthCounts.items():
+            d = 1
+            while d * d <= length:
+                if length % d == 0:
+                    if d in candidates:
+                        scores[d] += count
+                    otherDivisor = length // d
+                    if otherDivisor != d and otherDivisor in candidates:
+                        scores[otherDivisor] += count
+                d += 1
+
+        return min(scores, key=lambda length: (-scores[length], length))
+
+    # Return the mean distance (as a fraction of the base length, from 0 for
+    # a perfect fit to 0.5) between each note's length and the nearest
+    # multiple of the base length
+    @staticmethod
+    def find_quantization_error(lengthCounts, baseTicks):
+        noteCount = sum(lengthCounts.values())
+        if noteCount == 0 or not baseTicks:
+            return 0.0
+
+        totalError = 0
+        for length, count in lengthCounts.items():
+            remainder = length % baseTicks
+            totalError += min(remainder, baseTicks - remainder) * count
 
+        return totalError / (noteCount * baseTicks)
 
     def quantize_length(self, ticks):
         return int(self.baseTicks * round(ticks / self.baseTicks))
 
-    # Find the first SET_TEMPO event and take that to be the tempo of the whole
-    # song.  Then, use math along with the BPM to convert that to the
-    # equivalent PICO-8 note duration
-    def find_note_duration(self):
-        if self.settings.noteDurationOverride != None:
-            return self.settings.noteDurationOverride
+    # Find the first SET_TEMPO event (in the first track that has one) and take
+    # that to be the tempo of the whole song, and convert it to milliseconds
+    # per MIDI tick. This only depends on the MIDI file, so it is only worked
+    # out once.
+    def find_midi_ms_per_tick(self):
+        if self.midiMsPerTick != None:
+            return self.midiMsPerTick
 
         ppq = self.midiFile.ticksPerQuarterNote
         ## Find the PPQ from the first TIME_SIGNATURE event
@@ -187,32 +364,43 @@ class Translator:
         #            #break
 
         # Find the microseconds per MIDI quarter note from the first SET_TEMPO
-        # event
+        # event (tracks that aren't translated are searched without being
+        # decoded, and the tracks after the one that has it aren't searched)
         mpqn = None
         for track in self.midiFile.tracks:
-            for e, event in enumerate(track.events):
-                if event.type == 'SET_TEMPO':
-                    mpqn = int.from_bytes(
-                            event.data,
-                            byteorder='big',
-                            signed=False)
-                    break
-
+            event = track.find_first_event('SET_TEMPO')
+            if event != None:
+                mpqn = int.from_bytes(
+                        event.data,
+                        byteorder='big',
+                        signed=False)
+                break
 
         if mpqn != None:
             bpm = 60000000 / mpqn
         else:
             bpm = MIDI_DEFAULT_BPM
 
-        midiMsPerTick = 60000 / (bpm * ppq)
+        self.midiMsPerTick = 60000 / (bpm * ppq)
 
         # DEBUG
         #print('ppq: ' + str(ppq))
         #print('mpqn: ' + str(mpqn))
         #print('bpm: ' + str(bpm))
-        #print('MIDI msPerTick: ' + str(midiMsPerTick))
+        #print('MIDI msPerTick: ' + str(self.midiMsPerTick))
         #print('PICO-8 msPerTick: ' + str(PICO8_MS_PER_TICK))
 
+        return self.midiMsPerTick
+
+    # Use the MIDI tempo to convert the base note length to the equivalent
+    # PICO-8 note duration. Only the tempo is cached, so changes to the
+    # settings or to baseTicks are always taken into account.
+    def find_note_duration(self):
+        if self.settings.noteDurationOverride != None:
+            return self.settings.noteDurationOverride
+
+        midiMsPerTick = self.find_midi_ms_per_tick()
+
         d = round(self.baseTicks * (midiMsPerTick / PICO8_MS_PER_TICK))
         if d < PICO8_MIN_NOTE_DURATION:
             d = PICO8_MIN_NOTE_DURATION
@@ -224,58 +412,73 @@ class Translator:
             deltaTime = self.quantize_length(deltaTime)
 
             if deltaTime != originalDeltaTime:
-                print('quantized deltaTime {0} to {1}'.format(
-                    originalDeltaTime, deltaTime))
+                self.quantizedNoteCount += 1
+                self.quantizationDrift += abs(deltaTime - originalDeltaTime)
 
         return int(deltaTime / self.baseTicks)
 
-    def get_pico_notes(self, track, channel):
-        picoTrack = []
+    # Convert MIDI notes into a run-length PICO-8 note stream: a NoteBuffer
+    # with one row per MIDI note (or rest), whose length is the number of
+    # PICO-8 notes it lasts. A run's effect only applies to its last PICO-8
+    # note. The runs are only expanded into individual PICO-8 notes by
+    # split_into_sfxes().
+    def get_pico_notes(self, notes):
+        picoTrack = NoteBuffer()
 
-        notes = self.find_notes(track, channel)
         for n, note in enumerate(notes):
-            note.length = self.convert_ticks_to_notelength(note.midiDuration)
-            for i in range(note.length):
-                # Create a copy of the note
-                noteCopy = copy.copy(note)
-
-                if not self.settings.legato:
-                    # If this is the last copy of this note
-                    if i == note.length - 1:
-                        # Find the next note
-                        if n < len(notes) - 1:
-                            nextNote = notes[n + 1]
-                        else:
-                            nextNote = None
-
-                        # If the next note is the same pitch
-                        if nextNote and nextNote.pitch == noteCopy.pitch:
-                            nextNoteIsSamePitch = True
-                        else:
-                            nextNoteIsSamePitch = False
-                        if nextNoteIsSamePitch or self.settings.staccato:
-                            # Give the note a fadeout effect
-                            noteCopy.effect = 5
-
-                picoTrack.append(noteCopy)
+            length = self.convert_ticks_to_notelength(note.midiDuration)
+            if length == 0:
+                continue
+
+            effect = note.effect
+            if not self.settings.legato:
+                # Find the next note
+                if n < len(notes) - 1:
+                    nextNote = notes[n + 1]
+                else:
+                    nextNote = None
 
-        return picoTrack
+                # If the next note is the same pitch
+                if nextNote and nextNote.pitch == note.pitch:
+                    nextNoteIsSamePitch = True
+                else:
+                    nextNoteIsSamePitch = False
+                if nextNoteIsSamePitch or self.settings.staccato:
+                    # Give the end of the note a fadeout effect
+                    effect = 5
 
-    def find_occupied_channels(self, track):
-        occupiedChannels = []
+            picoTrack.append(note.pitch, note.volume, note.waveform, effect,
+                             length)
 
-        for event in track.events:
-            if not event.channel in occupiedChannels:
-                occupiedChannels.append(event.channel)
+        return picoTrack
 
-        return occupiedChannels
+    def find_occupied_channels(self, track):
+        # The track records the channels in order of first appearance while
+        # it is decoded, including the channels of events that were skipped
+        # because they aren't in MIDI_EVENT_TYPES
+        return list(track.channelOrder)
 
+    # Find the index of the first audible PICO-8 note (counting each run as
+    # many notes as it is long) in the first track that has one
     @staticmethod
     def find_first_audible_note_index(picoNoteLists):
-        for t, noteList in enumerate(picoNoteLists):
-            for n, note in enumerate(noteList):
-                if note.volume > 0:
-                    return n
+        for t, runs in enumerate(picoNoteLists):
+            r = runs.find_first_audible_index()
+            if r != None:
+                return sum(runs.lengths[runs.start:runs.start + r])
+
+    # Remove the first "count" PICO-8 notes from a run-length NoteBuffer
+    @staticmethod
+    def drop_notes_from_runs(runs, count):
+        for r in range(len(runs)):
+            length = runs.length(r)
+            if count < length:
+                # Keep the end of this run
+                runs.set_length(r, length - count)
+                return runs[r:]
+            count -= length
+
+        return runs[len(runs):]
 
     @staticmethod
     def trim_silence_from_beginning_of_pico_notes(picoNoteLists):
@@ -283,61 +486,91 @@ class Translator:
         if firstNoteIndex > 0:
             # Trim empty notes off the beginning of all tracks
             for i in range(0, len(picoNoteLists)):
-                picoNoteLists[i] = picoNoteLists[i][firstNoteIndex:]
-        print('trimmed {0} silent notes from the beginning'.format(
+                picoNoteLists[i] = Translator.drop_notes_from_runs(
+                        picoNoteLists[i], firstNoteIndex)
+        util.write('trimmed {0} silent notes from the beginning\n'.format(
             firstNoteIndex))
 
     @staticmethod
     def trim_empty_notes_from_end_of_sfx_list(sfxes):
         if len(sfxes) > 0:
             # Trim empty notes off the end of the last Sfx
-            lastNoteIndex = None
-            for i in range(len(sfxes[-1].notes) - 1, -1, -1):
-                if sfxes[-1].notes[i].volume > 0:
-                    lastNoteIndex = i
-                    break
+            lastNoteIndex = sfxes[-1].notes.find_last_audible_index()
             if lastNoteIndex != None:
                 sfxes[-1].notes = sfxes[-1].notes[:lastNoteIndex + 1]
 
 
-    def split_into_sfxes(self, notes):
+    # Expand a run-length NoteBuffer into SFXes of 32 PICO-8 notes each,
+    # filling one SFX at a time, so the whole track is never expanded at once.
+    # Each run becomes as many notes as it is long, and only the last of them
+    # keeps the run's effect. The SFXes' notes have no length column.
+    def split_into_sfxes(self, runs):
         sfxes = []
-
-        for i in range(0, len(notes), PICO8_NOTES_PER_SFX):
-            sfx = Sfx(notes[i:i + PICO8_NOTES_PER_SFX])
-            sfx.noteDuration = self.find_note_duration()
-            sfxes.append(sfx)
+        noteDuration = self.find_note_duration()
+
+        free = 0
+        for r in range(len(runs)):
+            pitch = runs.pitch(r)
+            volume = runs.volume(r)
+            waveform = runs.waveform(r)
+            remaining = runs.length(r)
+            while remaining > 0:
+                if free == 0:
+                    notes = NoteBuffer(lengths=False)
+                    sfx = Sfx(notes)
+                    sfx.noteDuration = noteDuration
+                    sfxes.append(sfx)
+                    free = PICO8_NOTES_PER_SFX
+
+                count = min(remaining, free)
+                free -= count
+                remaining -= count
+                if remaining == 0:
+                    # The run ends in this SFX
+                    if count > 1:
+                        notes.append(pitch, volume, waveform, count=count - 1)
+                    notes.append(pitch, volume, waveform, runs.effect(r))
+                else:
+                    notes.append(pitch, volume, waveform, count=count)
 
         return sfxes
 
     def get_sfx_lists(self):
-        picoNoteLists = []
+        # analyze() found no notes to work out a base note length from
+        if self.baseTicks == None:
+            return []
 
-        for t, midiTrack in enumerate(self.midiFile.tracks):
-            # Find the channels in use in this track
-            usedChannels = self.find_occupied_channels(midiTrack)
+        # Count the quantized notes of this call only
+        self.quantizedNoteCount = 0
+        self.quantizationDrift = 0
 
-            # Separate each channel into a "track"
-            for channel in usedChannels:
-                picoNotes = self.get_pico_notes(midiTrack, channel)
+        picoNoteLists = []
 
-                hasAudibleNotes = False
-                for note in picoNotes:
-                    if note.volume > 0:
-                        hasAudibleNotes = True
-                        break
+        # Each channel of each MIDI track becomes a separate "track"
+        for midiTrack, channel, notes in self.get_channel_notes():
+            picoNotes = self.get_pico_notes(notes)
 
-                # If this track has any notes
-                if len(picoNotes) > 0 and hasAudibleNotes:
-                    picoNoteLists.append(picoNotes)
+            # If this track has any notes
+            if picoNotes.find_first_audible_index() != None:
+                picoNoteLists.append(picoNotes)
 
         if self.settings.fixOctaves:
             picoNoteLists = self.adjust_octaves(picoNoteLists)
 
-        print('got a total of {0} translated tracks'.format(len(picoNoteLists)))
+        if self.quantizedNoteCount > 0:
+            util.write(('quantized {0} note lengths (total drift: {1} ' +
+                        'MIDI ticks)\n').format(self.quantizedNoteCount,
+                                                self.quantizationDrift))
+
+        util.write('got a total of {0} translated tracks\n'.format(
+            len(picoNoteLists)))
 
-        # OPTIMIZATION TODO: Try to combine tracks if they have no overlapping
-        # notes
+        # Combine tracks that are never audible at the same time
+        if self.settings.mergeTracks:
+            trackMerger = TrackMerger(picoNoteLists,
+                                      legato=self.settings.legato)
+            picoNoteLists = trackMerger.run()
+            util.write('merged into {0} tracks\n'.format(len(picoNoteLists)))
 
         # Trim silence from the beginning of the song as a whole
         if self.settings.trimSilence:
@@ -351,57 +584,67 @@ class Translator:
             sfxLists.append(sfxes)
 
         if self.settings.sfxCompactor:
-            print('trying to save SFX slots by compacting repeated notes...')
-            sfxCompactor = SfxCompactor(sfxLists)
+            util.write('trying to save SFX slots by compacting repeated ' +
+                       'notes...\n')
+            sfxCompactor = SfxCompactor(
+                    sfxLists, greedy=self.settings.greedyCompaction,
+                    independent=self.settings.independentCompaction)
             sfxLists = sfxCompactor.run()
 
         return sfxLists
 
+    # Find the number of octaves to shift a track by so its audible notes
+    # (given as a histogram of pitches) fit in the PICO-8 pitch range. If no
+    # shift makes the whole track fit, return None, or in "best fit" mode the
+    # shift that leaves the fewest notes out of range.
+    @staticmethod
+    def find_octave_shift(pitchCounts, bestFit=False):
+        if len(pitchCounts) == 0:
+            return 0
+        lowest = min(pitchCounts)
+        highest = max(pitchCounts)
+
+        # The range of shifts that bring the lowest note up to 0 and the
+        # highest note down to PICO8_MAX_PITCH
+        minShift = -(lowest // 12)
+        maxShift = (PICO8_MAX_PITCH - highest) // 12
+
+        if minShift <= maxShift:
+            # Move as few octaves as possible
+            return min(max(0, minShift), maxShift)
+
+        if not bestFit:
+            return None
+
+        # The track is too wide to fit, so any shift between maxShift and
+        # minShift may be the best; prefer the smallest one when tied
+        bestShift = None
+        bestOutOfRangeCount = None
+        for shift in sorted(range(maxShift, minShift + 1), key=abs):
+            outOfRangeCount = 0
+            for pitch, count in pitchCounts.items():
+                if not 0 <= pitch + (shift * 12) <= PICO8_MAX_PITCH:
+                    outOfRangeCount += count
+            if bestShift == None or outOfRangeCount < bestOutOfRangeCount:
+                bestShift = shift
+                bestOutOfRangeCount = outOfRangeCount
+
+        return bestShift
+
     def adjust_octaves(self, tracks):
         for t, track in enumerate(tracks):
-            raised = False
-            lowered = False
-            while True:
-                trackGoesTooLow = False
-                trackGoesTooHigh = False
-
-                # Check if any notes are out of range
-                for note in track:
-                    if note.volume > 0 and note.pitch != None:
-                        if note.pitch < 0:
-                            trackGoesTooLow = True
-                        elif note.pitch > PICO8_MAX_PITCH:
-                            trackGoesTooHigh = True
-
-                if trackGoesTooLow and trackGoesTooHigh:
-                    print('track {0} goes out of range in both directions; ' +
-                          'octave will not be adjusted'.format(t))
-                    break
-                elif trackGoesTooLow:
-                    print('pitching out-of-range track {0} up an octave'.
-                          format(t))
-                    # Add an octave to every note in this track
-                    raised = True
-                    for note in track:
-                        if note.pitch != None:
-                            note.pitch += 12
-
-                elif trackGoesTooHigh:
-                    print('pitching out-of-range track {0} down an octave'.
-                          format(t))
-                    # Subtract an octave from every note in this track
-                    lowered = True
-                    for note in track:
-                        if note.pitch != None:
-                            note.pitch -= 12
-                else:
-                    break
-
-                # Prevent ping-ponging back and forth infinitely
-                if raised and lowered:
-                    break
+            shift = Translator.find_octave_shift(
+                    track.count_audible_pitches(),
+                    self.settings.bestFitOctaves)
+
+            if shift == None:
+                util.error(('track {0} goes out of range in both ' +
+                            'directions; octave will not be adjusted\n').
+                           format(t))
+            elif shift != 0:
+                util.write(('pitching out-of-range track {0} {1} {2} ' +
+                            'octave(s)\n').format(
+                                t, 'up' if shift > 0 else 'down', abs(shift)))
+                track.transpose(shift * 12)
 
         return tracks
-
-
-